@@ -0,0 +1,288 @@
+##
+# Columnar on-disk cache of cleaned PIN attempts, so that retrieve_data,
+# preprocess_data and clean_data only run again when the database changes
+##
+from collections import defaultdict
+from common import DATABASE, EXCLUDED_USERS, KEYPAD, key_index, retrieve_data_chunks, stream_clean_data
+import numpy as np
+import profiling
+import tempfile
+import shutil
+import json
+import os
+
+# bump this whenever the layout of the cache, the order attempts are stored in,
+# or the cleaning it caches changes
+# 2: users and attempts in (user, PIN, time, rowid) order, from stream_clean_data
+# 3: stamp.json holds the stamp along with the counts of the cleaning
+# 4: attempts typed with extra leading zeroes are thrown out as incorrect
+CACHE_VERSION = 4
+
+# the arrays that make up a cache, each kept in its own .npy file
+COLUMNS = ["user_names", "attempt_users", "attempt_pins", "attempt_offsets", "keys", "times"]
+
+# what is counted while the attempts of a cache are cleaned; on a cache hit, these are
+# reported to profiling under the same names ("common." + name) as when they are cleaned
+CLEAN_COUNTS = ["rows_read", "attempts_kept", "attempts_rejected_backspace",
+                "attempts_rejected_incorrect", "attempts_rejected_unfinished"]
+
+
+class CleanedAttempts:
+    ##
+    # Constructor for the cleaned attempts of every user, stored as flat arrays
+    #
+    # @input user_names - an array of every user
+    # @input attempt_users - an int32 array of the index (into user_names) of the user of every attempt
+    # @input attempt_pins - an int32 array of the PIN of every attempt
+    # @input attempt_offsets - an int64 array where attempt i covers keys[attempt_offsets[i]:attempt_offsets[i + 1]]
+    # @input keys - an int8 array of the index (into KEYPAD) of every key pressed
+    # @input times - an int64 array of the time of every key pressed, in microseconds since the epoch
+    # @input counts - a dictionary of the CLEAN_COUNTS of the cleaning the attempts came from, if known
+    def __init__(self, user_names, attempt_users, attempt_pins, attempt_offsets, keys, times, counts=None):
+        self.user_names = user_names
+        self.attempt_users = attempt_users
+        self.attempt_pins = attempt_pins
+        self.attempt_offsets = attempt_offsets
+        self.keys = keys
+        self.times = times
+        self.counts = counts or {}
+
+    ##
+    # This function flattens a stream of attempts into arrays
+    #
+    # @input attempts - an iterable of triples of (user, PIN, attempt), such as stream_clean_data returns
+    # @returns the same attempts as a CleanedAttempts, with users numbered in the order they first appear
+    @staticmethod
+    def from_attempts(attempts):
+        user_ids = {}
+        user_names, attempt_users, attempt_pins, attempt_offsets, keys, times = [], [], [], [0], [], []
+
+        for user, pin, attempt in attempts:
+            if user not in user_ids:
+                user_ids[user] = len(user_names)
+                user_names.append(user)
+
+            attempt_users.append(user_ids[user])
+            attempt_pins.append(pin)
+            keys.extend([key_index[key] for (key, time) in attempt])
+            times.extend([time for (key, time) in attempt])
+            attempt_offsets.append(len(keys))
+
+        return CleanedAttempts(np.array(user_names, dtype=np.unicode_),
+                               np.array(attempt_users, dtype=np.int32),
+                               np.array(attempt_pins, dtype=np.int32),
+                               np.array(attempt_offsets, dtype=np.int64),
+                               np.array(keys, dtype=np.int8),
+                               np.array(times, dtype=np.int64))
+
+    ##
+    # This function rebuilds the output of clean_data from the arrays
+    #
+    # @returns a dictionary of dictionaries of lists of lists of pairs of keystrokes and timings
+    def to_keystrokes(self):
+        keystrokes = defaultdict(lambda: defaultdict(lambda: []))
+
+        user_names = [str(user) for user in self.user_names]
+        keys = [KEYPAD[key] for key in self.keys.tolist()]
+        times = self.times.tolist()
+        offsets = self.attempt_offsets.tolist()
+
+        for i, (user_id, pin) in enumerate(zip(self.attempt_users.tolist(), self.attempt_pins.tolist())):
+            keystrokes[user_names[user_id]][pin].append(list(zip(keys[offsets[i]:offsets[i + 1]], times[offsets[i]:offsets[i + 1]])))
+
+        return keystrokes
+
+    ##
+    # This function picks out some of the attempts
+    #
+    # @input which - an array of attempt indices
+    # @returns a CleanedAttempts of just those attempts (copied out of the columns), with the same user_names
+    def select(self, which):
+        which = np.asarray(which, dtype=np.int64)
+        offsets = np.asarray(self.attempt_offsets)
+        starts = offsets[which]
+        lengths = offsets[which + 1] - starts
+
+        new_offsets = np.concatenate((np.zeros(1, dtype=np.int64), np.cumsum(lengths)))
+        positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+        return CleanedAttempts(self.user_names, np.asarray(self.attempt_users)[which], np.asarray(self.attempt_pins)[which],
+                               new_offsets, np.asarray(self.keys)[positions], np.asarray(self.times)[positions])
+
+    ##
+    # @input user - the name of a user
+    # @returns a CleanedAttempts of every attempt of that user, in the order they are stored
+    def for_user(self, user):
+        user_ids = [user_id for user_id, name in enumerate(self.user_names) if str(name) == user]
+        return self.select(np.flatnonzero(np.in1d(self.attempt_users, user_ids)))
+
+    ##
+    # This function takes the interkey timings of some attempts straight from the columns
+    #
+    # @input which - an array of attempt indices, every one with the same number of keys
+    # @returns an int64 array shaped (len(which), keys - 1) of the timings of every attempt, in ms
+    def interkey_timings(self, which):
+        which = np.asarray(which, dtype=np.int64)
+        offsets = np.asarray(self.attempt_offsets)
+        if which.shape[0] == 0:
+            return np.zeros((0, 0), dtype=np.int64)
+
+        keys = int(offsets[which[0] + 1] - offsets[which[0]])
+        times = np.asarray(self.times)[offsets[which][:, np.newaxis] + np.arange(keys)]
+        # the same as interkey_ms, for every pair of consecutive keys at once
+        return (times[:, 1:] - times[:, :-1]) // (10**3)
+
+    ##
+    # @returns the number of attempts
+    def __len__(self):
+        return self.attempt_users.shape[0]
+
+
+##
+# This function describes the database a cache was made from, so that a stale cache can be spotted
+#
+# @input database - the path of the SQLite database
+# @input excluded_users - the users left out of the cache
+# @returns a dictionary that changes whenever the database or the cache layout does
+def cache_stamp(database, excluded_users):
+    stat = os.stat(database)
+    return {
+        "version": CACHE_VERSION,
+        "database_mtime": stat.st_mtime,
+        "database_size": stat.st_size,
+        "excluded_users": sorted(excluded_users)
+    }
+
+##
+# @input database - the path of the SQLite database
+# @returns the directory that the cache of a database lives in
+def cache_path(database):
+    return database + ".cache"
+
+##
+# This function writes cleaned attempts to disk, replacing any older cache. Several processes
+# may build the same cache at once (e.g. two runs on a new database), so each one writes into
+# a directory of its own, and whichever renames its directory into place first wins
+#
+# @input attempts - a CleanedAttempts
+# @input path - the directory to write the cache into
+# @input stamp - the cache_stamp of the database the attempts came from
+# @returns True if this process wrote the cache, or False if another process had already put a current one in place
+def save_cache(attempts, path, stamp):
+    # write everything next to the cache first, so a cache is never seen half-written
+    temp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        for column in COLUMNS:
+            np.save(os.path.join(temp_path, column + ".npy"), getattr(attempts, column))
+        with open(os.path.join(temp_path, "stamp.json"), 'w') as f:
+            json.dump({"stamp": stamp, "counts": attempts.counts}, f)
+
+        if os.path.exists(path):
+            if load_cache(path, stamp) is not None:
+                return False
+            remove_stale_cache(path)
+
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # another process renamed its cache into place since the check above
+            if load_cache(path, stamp) is not None:
+                return False
+            raise
+        return True
+    finally:
+        shutil.rmtree(temp_path, True)
+
+##
+# This function removes a stale cache. It is moved aside first (which only one process can do),
+# so that a current cache another process has just put in place is never removed instead
+#
+# @input path - the directory of the cache
+def remove_stale_cache(path):
+    stale_path = tempfile.mkdtemp(prefix=os.path.basename(path) + ".", suffix=".stale", dir=os.path.dirname(path) or ".")
+    try:
+        os.rename(path, os.path.join(stale_path, "cache"))
+    except OSError:
+        # another process moved it first
+        pass
+    shutil.rmtree(stale_path, True)
+
+##
+# This function reads cleaned attempts from disk, memory-mapped, if the cache is current
+#
+# @input path - the directory of the cache
+# @input stamp - the cache_stamp of the database the attempts should come from
+# @returns a CleanedAttempts (with the counts of the cleaning it came from), or None if there is no cache or it is stale
+def load_cache(path, stamp):
+    try:
+        with open(os.path.join(path, "stamp.json")) as f:
+            saved = json.load(f)
+        if saved.get("stamp") != stamp:
+            return None
+        return CleanedAttempts(*[np.load(os.path.join(path, column + ".npy"), mmap_mode='r') for column in COLUMNS],
+                               counts=dict((str(name), value) for name, value in saved["counts"].items()))
+    except (IOError, OSError, ValueError, KeyError, AttributeError):
+        return None
+
+##
+# This function counts the rows of a stream of chunks as they go by
+#
+# @input chunks - an iterable of lists of rows (e.g. retrieve_data_chunks())
+# @input counts - a dictionary whose "rows_read" gets the number of rows added to it
+# @returns a generator of the same chunks
+def count_rows(chunks, counts):
+    for chunk in chunks:
+        counts["rows_read"] += len(chunk)
+        yield chunk
+
+##
+# This function streams the data out of the database and cleans it, counting what the cleaning does
+#
+# @input database - the path of the SQLite database
+# @input excluded_users - a list of users to leave out
+# @returns a CleanedAttempts, with the CLEAN_COUNTS of the cleaning
+def clean_attempts(database, excluded_users):
+    counts = {"rows_read": 0}
+    rejected = {}
+    attempts = CleanedAttempts.from_attempts(stream_clean_data(count_rows(retrieve_data_chunks(database, excluded_users), counts), rejected))
+
+    counts["attempts_kept"] = len(attempts)
+    for reason, value in rejected.items():
+        counts["attempts_rejected_" + reason] = value
+    attempts.counts = counts
+
+    return attempts
+
+##
+# This function gets the cleaned attempts of a database, from the cache if it is
+# current, or else by streaming the data out of the database and cleaning it (and caching it)
+#
+# @input database - the path of the SQLite database
+# @input excluded_users - a list of users to leave out
+# @returns a CleanedAttempts
+@profiling.timed("attempt_cache.load_attempts")
+def load_attempts(database=DATABASE, excluded_users=EXCLUDED_USERS):
+    stamp = cache_stamp(database, excluded_users)
+    path = cache_path(database)
+
+    attempts = load_cache(path, stamp)
+    profiling.count("attempt_cache.hits" if attempts is not None else "attempt_cache.misses")
+    if attempts is None:
+        attempts = clean_attempts(database, excluded_users)
+        save_cache(attempts, path, stamp)
+    else:
+        # nothing was read or cleaned, so report what was when the cache was made
+        for name in CLEAN_COUNTS:
+            profiling.count("common." + name, attempts.counts.get(name, 0))
+
+    return attempts
+
+##
+# This function gets the output of clean_data for a database, going through the cache
+#
+# @input database - the path of the SQLite database
+# @input excluded_users - a list of users to leave out
+# @returns a dictionary of dictionaries of lists of lists of pairs of keystrokes and timings
+def load_keystrokes(database=DATABASE, excluded_users=EXCLUDED_USERS):
+    return load_attempts(database, excluded_users).to_keystrokes()
+
+# End of file
@@ -0,0 +1,168 @@
+##
+# Benchmarks of every stage of the pipeline, from reading the database to
+# ranking PINs, run on synthetic databases of several sizes
+##
+from common import *
+from attempt_cache import load_attempts, cache_path
+from synthetic_db import generate_database
+from model import Model, set_fit_cache
+from tree import Tree
+from scorer import Scorer
+import inference
+import numpy as np
+import subprocess
+import platform
+import tempfile
+import argparse
+import shutil
+import json
+import time
+
+##
+# This function times a stage of the pipeline, running it several times
+#
+# @input stage - a function to time, which takes the output of setup
+# @input setup - a function that gets the arguments of stage ready (not timed),
+#                   so that stages that change their input get a fresh copy each run
+# @input repeat - how many times to run the stage
+# @returns a dictionary of the fastest and mean run, in seconds
+def time_stage(stage, setup=lambda: (), repeat=3):
+    runs = []
+    for i in range(repeat):
+        arguments = setup()
+        start = time.time()
+        stage(*arguments)
+        runs.append(time.time() - start)
+    return {"best_s": min(runs), "mean_s": sum(runs) / len(runs), "runs": repeat}
+
+##
+# @returns the commit the benchmarks ran on, or None if git can't tell
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+##
+# This function times every stage of the pipeline on one database
+#
+# @input directory - the directory holding the database (DATABASE)
+# @input repeat - how many times to run every stage but the end-to-end run
+# @returns a dictionary connecting every stage to its timings
+def benchmark_database(directory, repeat=3):
+    database = os.path.join(directory, DATABASE)
+    stages = {}
+
+    res = retrieve_data(database)
+    stages["retrieve_data"] = time_stage(retrieve_data, lambda: (database,), repeat)
+    stages["preprocess_data"] = time_stage(preprocess_data, lambda: (res, True), repeat)
+
+    keystrokes = clean_data(preprocess_data(res, True))
+    stages["clean_data"] = time_stage(clean_data, lambda: (preprocess_data(res, True),), repeat)
+    stages["parse_data"] = time_stage(parse_data, lambda: (keystrokes,), repeat)
+
+    timings = parse_data(keystrokes)
+    stages["filter_timings"] = time_stage(filter_timings, lambda: (timings,), repeat)
+
+    # fits are remembered, so forget them before every run to time the fits themselves
+    filtered = filter_timings(timings)
+    stages["Model"] = time_stage(Model, lambda: (set_fit_cache(None) or (filtered,)), repeat)
+
+    # rank the PINs of the first attempt of the first user
+    model = Model(filtered)
+    user = sorted(keystrokes.keys())[0]
+    attempt = keystrokes[user][sorted(keystrokes[user].keys())[0]][0]
+    attempt_timings = [interkey_ms(time_a, time_b) for ((key_a, time_a), (key_b, time_b)) in zip(attempt[:-1], attempt[1:])]
+
+    stages["Tree"] = time_stage(Tree, lambda: [model] + attempt_timings, repeat)
+    tree = Tree(model, *attempt_timings)
+    stages["Tree.rank_by_probability"] = time_stage(tree.rank_by_probability, repeat=repeat)
+    stages["Scorer"] = time_stage(Scorer, lambda: [model] + attempt_timings, repeat)
+
+    # reading the cache is only timed once it exists
+    stages["load_attempts (no cache)"] = time_stage(load_attempts, lambda: (shutil.rmtree(cache_path(database), True) or (database,)), repeat)
+    stages["load_attempts (cached)"] = time_stage(load_attempts, lambda: (database,), repeat)
+
+    # the whole leave-one-user-out run, from an empty cache of attempts
+    shutil.rmtree(cache_path(database), True)
+    with cd(directory):
+        with change_stdout(os.devnull):
+            stages["inference.main"] = time_stage(inference.main, lambda: (argparse.Namespace(jobs=1, model="gamma", warm_start=False, no_fit_cache=True, profile=None),), 1)
+
+    return stages
+
+##
+# This function benchmarks the pipeline on synthetic databases of several sizes
+#
+# @input sizes - a list of the number of users of every database
+# @input pins - the number of PINs every user enters
+# @input attempts - the number of times every user enters every PIN
+# @input repeat - how many times to run every stage but the end-to-end run
+# @input seed - the seed of the synthetic databases
+# @returns a dictionary of the results, along with what they were run on
+def run_benchmarks(sizes, pins=40, attempts=4, repeat=3, seed=0):
+    results = {
+        "commit": current_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "sizes": []
+    }
+
+    for users in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            rows = generate_database(os.path.join(directory, DATABASE), users=users, pins=pins, attempts=attempts, seed=seed)
+            results["sizes"].append({
+                "users": users,
+                "pins": pins,
+                "attempts": attempts,
+                "keystrokes": rows,
+                "stages": benchmark_database(directory, repeat)
+            })
+        finally:
+            shutil.rmtree(directory, True)
+
+    return results
+
+##
+# This function prints how every stage changed from one set of results to another
+#
+# @input old - the results to compare against
+# @input new - the results just run
+def compare_results(old, new):
+    old_sizes = dict((size["users"], size) for size in old["sizes"])
+    print "compared against commit " + str(old.get("commit"))
+
+    for size in new["sizes"]:
+        if size["users"] not in old_sizes:
+            continue
+        print "---"
+        print str(size["users"]) + " users:"
+        for stage, timing in sorted(size["stages"].items()):
+            old_timing = old_sizes[size["users"]]["stages"].get(stage)
+            if old_timing is None or old_timing["best_s"] == 0:
+                continue
+            print "%-28s %9.4fs -> %9.4fs (%.2fx)" % (stage, old_timing["best_s"], timing["best_s"], timing["best_s"] / old_timing["best_s"])
+
+# python benchmark.py [--sizes 6,12,24] [--pins N] [--attempts N] [--repeat N] [--seed N] [--output FILE] [--compare FILE]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Specify arguments')
+    parser.add_argument('--sizes', help='comma-separated numbers of users to benchmark with', default="6,12,24")
+    parser.add_argument('--pins', help='number of PINs every user enters', type=int, default=40)
+    parser.add_argument('--attempts', help='number of times every user enters every PIN', type=int, default=4)
+    parser.add_argument('--repeat', help='number of times to run every stage', type=int, default=3)
+    parser.add_argument('--seed', help='seed of the synthetic databases', type=int, default=0)
+    parser.add_argument('--output', help='file to write the results into, as JSON', default="benchmark.json")
+    parser.add_argument('--compare', help='results of an earlier run to compare against', default=None)
+    args = parser.parse_args()
+
+    results = run_benchmarks([int(size) for size in args.sizes.split(",")], args.pins, args.attempts, args.repeat, args.seed)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print "results written to " + args.output
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
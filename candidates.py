@@ -0,0 +1,203 @@
+##
+# CandidateList class that ranks a list of candidate PINs kept on disk (such as a
+# list of leaked PINs, or millions of 6-digit PINs) rather than every possible PIN.
+# The list is memory-mapped and scored a chunk at a time, so memory use stays the
+# same no matter how long the list is
+##
+from common import *
+from scorer import top_pins, digit_scores
+import profiling
+import argparse
+
+# how many candidates are scored at a time
+CHUNK_SIZE = 1 << 16
+
+##
+# This function writes candidates into a file CandidateList can read: one PIN per
+# line, every line the same width
+#
+# @input path - the file to write
+# @input pins - a list of PINs, as strings (e.g. "0012") or ints
+# @input width - the number of digits of every PIN (ints are padded with zeroes)
+def write_candidates(path, pins, width=4):
+    with open(path, 'w') as f:
+        for pin in pins:
+            pin = str(pin).zfill(width)
+            if len(pin) != width or not pin.isdigit():
+                raise ValueError("not a " + str(width) + "-digit PIN: " + pin)
+            f.write(pin + "\n")
+
+
+class CandidateList:
+    ##
+    # Constructor for a list of candidates, which maps the files rather than reading them
+    #
+    # @input path - a file of PINs, one per line, every line the same width
+    # @input prior_path - an optional .npy file of the log-prior of every candidate
+    #                       (e.g. the log of how often it shows up in a leak), added to its score
+    def __init__(self, path, prior_path=None):
+        self.path = path
+        self.prior = None
+
+        with open(path, 'rb') as f:
+            first_line = f.readline()
+        if not first_line.endswith("\n") or not first_line[:-1].isdigit():
+            raise ValueError(path + " does not start with a line of digits")
+        self.width = len(first_line) - 1
+
+        size = os.path.getsize(path)
+        if size % (self.width + 1) != 0:
+            raise ValueError(path + " has lines that are not all " + str(self.width) + " digits long")
+
+        # every row is a PIN, as the bytes of its digits followed by a newline
+        self.rows = np.memmap(path, dtype=np.uint8, mode='r', shape=(size // (self.width + 1), self.width + 1))
+
+        if prior_path is not None:
+            self.prior = np.load(prior_path, mmap_mode='r')
+            if self.prior.shape != (len(self),):
+                raise ValueError(prior_path + " does not have one log-prior per candidate")
+
+    ##
+    # @returns the number of candidates
+    def __len__(self):
+        return self.rows.shape[0]
+
+    ##
+    # This function reads the candidates a chunk at a time
+    #
+    # @input chunk_size - how many candidates to read at a time
+    # @returns a generator of (position of the first candidate, array of digits shaped (chunk, width),
+    #           array of log-priors or None) for every chunk
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        for start in range(0, len(self), chunk_size):
+            digits, prior = self.__read(start, min(start + chunk_size, len(self)))
+            yield start, digits, prior
+
+    ##
+    # This function finds where a PIN first shows up in the list
+    #
+    # @input pin - the PIN to find, as a string of digits (e.g. "0012") or an int (which is padded with zeroes)
+    # @input chunk_size - how many candidates to read at a time
+    # @returns the position of the PIN, or None if it isn't in the list (as a PIN of another width never is)
+    def position(self, pin, chunk_size=CHUNK_SIZE):
+        if isinstance(pin, (int, long, np.integer)):
+            pin = str(pin).zfill(self.width)
+        if not isinstance(pin, basestring) or not pin.isdigit():
+            raise ValueError("not a PIN: " + repr(pin))
+        if len(pin) != self.width:
+            return None
+        digits = np.array([int(digit) for digit in pin])
+
+        for start, chunk, prior in self.chunks(chunk_size):
+            found = np.flatnonzero((chunk == digits).all(axis=1))
+            if found.shape[0] > 0:
+                return start + int(found[0])
+        return None
+
+    ##
+    # This function ranks the candidates for an attempt, keeping only the best k of every
+    # chunk. Candidates that score the same are ranked in the order they are listed, as
+    # PINs that score the same are ranked in ascending order by rank_pins
+    #
+    # @input model - the model which predicts timings
+    # @input timings - the interkey timings of an attempt (one per digit)
+    # @input k - the number of candidates to return
+    # @input target - an optional PIN (a string or an int) to find the rank of
+    # @input chunk_size - how many candidates to score at a time
+    # @returns a list of the k best [pin, score], best first, and the number of candidates
+    #           guessed before the first time target is listed (None if there is no target, or it isn't listed)
+    @profiling.timed("candidates.rank")
+    def rank(self, model, timings, k=10, target=None, chunk_size=CHUNK_SIZE):
+        if len(timings) != self.width:
+            raise ValueError("expected " + str(self.width) + " timings, got " + str(len(timings)))
+        densities = model.log_densities(np.asarray(timings, dtype=float))
+
+        # the target's score is needed before any chunk can be counted against it
+        target_position = None if target is None else self.position(target, chunk_size)
+        target_score = None
+        if target_position is not None:
+            digits, prior = self.__read(target_position, target_position + 1)
+            target_score = self.__score(digits, densities, prior)[0]
+
+        best_positions = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0)
+        rank = 0
+
+        for start, digits, prior in self.chunks(chunk_size):
+            scores = self.__score(digits, densities, prior)
+            profiling.count("candidates.scored", scores.shape[0])
+
+            # merge this chunk's best with the best so far, breaking ties by position
+            chosen = top_pins(scores, k)
+            positions = np.concatenate((best_positions, start + chosen.astype(np.int64)))
+            merged = np.concatenate((best_scores, scores[chosen]))
+            order = np.lexsort((positions, -merged))[:k]
+            best_positions, best_scores = positions[order], merged[order]
+
+            if target_score is not None:
+                earlier = np.arange(start, start + scores.shape[0]) < target_position
+                rank += np.count_nonzero(scores > target_score) + np.count_nonzero((scores == target_score) & earlier)
+
+        best = [[self.__pin(position), score] for position, score in zip(best_positions, best_scores)]
+        return best, (None if target_score is None else int(rank))
+
+    ##
+    # This function scores a chunk of candidates, as digit_scores does, with their log-priors added on
+    #
+    # @input digits - an array of the digits of every candidate, shaped (chunk, width)
+    # @input densities - an array shaped (width, len(distance_classes)) of the logprob of
+    #                       every timing under every distance class
+    # @input prior - an array of the log-prior of every candidate, or None
+    # @returns an array of the score of every candidate
+    def __score(self, digits, densities, prior=None):
+        scores = digit_scores(densities, digits)
+        if prior is not None:
+            scores += prior
+        return scores
+
+    ##
+    # This function reads some of the candidates out of the mapped files
+    #
+    # @input start - the position of the first candidate
+    # @input stop - the position after the last candidate
+    # @returns an array of digits shaped (stop - start, width), and an array of log-priors or None
+    def __read(self, start, stop):
+        rows = np.asarray(self.rows[start:stop])
+        if (rows[:, self.width] != ord("\n")).any():
+            raise ValueError(self.path + " has lines that are not all " + str(self.width) + " digits long")
+
+        digits = rows[:, :self.width].astype(np.intp) - ord("0")
+        if ((digits < 0) | (digits > 9)).any():
+            raise ValueError(self.path + " has candidates that are not all digits")
+
+        prior = None if self.prior is None else np.asarray(self.prior[start:stop], dtype=float)
+        return digits, prior
+
+    ##
+    # @input position - the position of a candidate
+    # @returns the candidate, as a string
+    def __pin(self, position):
+        return self.rows[position, :self.width].tostring()
+
+# python candidates.py <candidates> <timings> [--prior PRIOR.npy] [--top K] [--target PIN] [--chunk_size N] [--database DB]
+if __name__ == "__main__":
+    from model import build_model
+
+    parser = argparse.ArgumentParser(description='Specify arguments')
+    parser.add_argument('candidates', help='file of candidate PINs, one per line, every line the same width')
+    parser.add_argument('timings', help='comma-separated interkey timings of the attempt, in ms (one per digit)')
+    parser.add_argument('--prior', help='.npy file of the log-prior of every candidate', default=None)
+    parser.add_argument('--top', help='number of candidates to report', type=int, default=10)
+    parser.add_argument('--target', help='PIN to report the rank of', default=None)
+    parser.add_argument('--chunk_size', help='number of candidates to score at a time', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--database', help='database to fit the model on', default=DATABASE)
+    args = parser.parse_args()
+
+    candidates = CandidateList(args.candidates, args.prior)
+    best, rank = candidates.rank(build_model(args.database), [float(timing) for timing in args.timings.split(",")],
+                                 args.top, args.target, args.chunk_size)
+
+    for pin, score in best:
+        print pin, score
+    if args.target is not None:
+        print "rank of " + args.target + ": " + ("not listed" if rank is None else str(rank))
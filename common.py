@@ -2,8 +2,9 @@ from contextlib import contextmanager
 from collections import defaultdict
 from dateutil import parser as prsr
 import numpy as np
+import profiling
+import datetime
 import sqlite3
-import math
 import sys
 import os
 
@@ -211,6 +212,85 @@ list_of_lists = {
     ]
 }
 
+# every key that can start or end a keypair, in the order used by the lookup table below
+KEYPAD = "0123456789" + CODE_FOR_ENTER
+key_index = dict((key, i) for i, key in enumerate(KEYPAD))
+
+# the distance classes used for inference, which split every keypair into exactly one class
+distance_classes = list_of_lists["model_sets"]
+distance_class_ids = dict((set_name, i) for i, set_name in enumerate(distance_classes))
+
+##
+# This function compiles the distance classes into a dense lookup table
+#
+# @returns an int8 array where [key_index[from_key], key_index[to_key]] holds
+#           the index in distance_classes of that keypair (or -1 if it has none)
+def _build_distance_class_table():
+    table = np.full((len(KEYPAD), len(KEYPAD)), -1, dtype=np.int8)
+
+    for class_id, set_name in enumerate(distance_classes):
+        for keypair in all_sets[set_name]:
+            table[key_index[keypair[0]], key_index[keypair[1]]] = class_id
+
+    return table
+
+distance_class_table = _build_distance_class_table()
+
+##
+# This function finds the distance class of a keypair
+#
+# @input from_key - the key pressed first (a digit or CODE_FOR_ENTER)
+# @input to_key - the key pressed second (a digit or CODE_FOR_ENTER)
+# @returns the index in distance_classes of the keypair, or -1 if it has none
+def distance_class(from_key, to_key):
+    try:
+        return int(distance_class_table[key_index[str(from_key)], key_index[str(to_key)]])
+    except KeyError:
+        return -1
+
+##
+# This function gives the name of a distance class
+#
+# @input class_id - the index of the class in distance_classes
+# @returns the name of the class (e.g. "dist_one"), or "" if there is no such class
+def distance_class_name(class_id):
+    if 0 <= class_id < len(distance_classes):
+        return distance_classes[class_id]
+    return ""
+
+##
+# This function collects every timing of every keypair in a set into one list
+#
+# @input timings - a dictionary of lists of ints, where the dictionary
+#                   connects a keypair (e.g. "12") to every interkey
+#                   timing used to enter it
+# @input given_set - the keypairs to collect (e.g. all_sets["dist_one"])
+# @returns a list of ints, in the order of the keypairs in the set
+def set_timings(timings, given_set):
+    # don't use timings[x], since that would add empty keypairs to a defaultdict
+    return [timing for keypair in given_set for timing in timings.get(keypair, [])]
+
+##
+# This function groups every timing by distance class in one pass over the keypairs,
+# looking the class of every keypair up in distance_class_table
+#
+# @input timings - a dictionary of lists of ints, where the dictionary
+#                   connects a keypair (e.g. "12") to every interkey
+#                   timing used to enter it (or a TimingStore, which is already grouped)
+# @returns a list of int64 arrays, one per class in the order of distance_classes,
+#           of every timing of the keypairs in that class (keypairs in no class are left out)
+def class_timings(timings):
+    if hasattr(timings, 'distance_class'):
+        return [timings.distance_class(set_name) for set_name in distance_classes]
+
+    pieces = [[np.zeros(0, dtype=np.int64)] for set_name in distance_classes]
+    for keypair, timing in timings.items():
+        class_id = distance_class(keypair[0], keypair[1]) if len(keypair) == 2 else -1
+        if class_id >= 0:
+            pieces[class_id].append(np.asarray(timing, dtype=np.int64))
+
+    return [np.concatenate(piece) for piece in pieces]
+
 ##
 # This functionality allows us to temporarily change our working directory
 #
@@ -238,41 +318,174 @@ def change_stdout(new_out):
         sys.stdout.close()
         sys.stdout = prev_out
 
+# the database that keystrokes are collected into
+DATABASE = 'attempts.db'
+
+# users whose keystrokes are left out of every analysis
+EXCLUDED_USERS = ["wpZ8r", "jFuj7", "c7fcH", "wtGa3"]
+
 ##
-# This function pulls data from the SQLite database
+# This function creates the index that lets SQLite hand back keystrokes
+# already ordered by user, PIN and time (it does nothing if the index exists)
+#
+# @input database - the path of the SQLite database
+def create_index(database=DATABASE):
+    conn = sqlite3.connect(database)
+    conn.execute('CREATE INDEX IF NOT EXISTS attempts_by_user_pin_time ON attempts (userString, pinAttempted, time)')
+    conn.commit()
+    conn.close()
+
+##
+# This function runs the query for every keystroke that isn't from an excluded user
 #
-# @returns a list of 4-tuples of keystroke timings
-def retrieve_data():
-    conn = sqlite3.connect('attempts.db')
+# @input conn - a connection to the SQLite database
+# @input excluded_users - a list of users to leave out
+# @returns a cursor over 4-tuples of keystroke timings, ordered by user, PIN and time
+#           (and by the order they were inserted, for keystrokes with the same time)
+def query_data(conn, excluded_users):
+    query = 'SELECT userString, pinAttempted, keyPressed, time FROM attempts'
+    if excluded_users:
+        query += ' WHERE userString NOT IN (' + ', '.join(['?'] * len(excluded_users)) + ')'
+    # every index entry ends with its rowid, so the index still hands back this order without sorting
+    query += ' ORDER BY userString, pinAttempted, time, rowid'
+
     c = conn.cursor()
+    c.execute(query, list(excluded_users))
+    return c
 
-    c.execute('SELECT userString, pinAttempted, keyPressed, time FROM attempts WHERE userString != "wpZ8r" AND userString != "jFuj7" AND userString != "c7fcH" AND userString != "wtGa3"')
-    res = c.fetchall()
+##
+# This function pulls data from the SQLite database
+#
+# @input database - the path of the SQLite database
+# @input excluded_users - a list of users to leave out
+# @input index - whether to create the index over (userString, pinAttempted, time) first
+# @returns a list of 4-tuples of keystroke timings, ordered by user, PIN and time
+@profiling.timed("common.retrieve_data")
+def retrieve_data(database=DATABASE, excluded_users=EXCLUDED_USERS, index=False):
+    if index:
+        create_index(database)
+
+    conn = sqlite3.connect(database)
+    res = query_data(conn, excluded_users).fetchall()
     conn.close()
 
+    profiling.count("common.rows_read", len(res))
+
     return res
 
+##
+# This function pulls data from the SQLite database a chunk at a time,
+# so that only one chunk of rows is ever held in memory
+#
+# @input database - the path of the SQLite database
+# @input excluded_users - a list of users to leave out
+# @input chunk_size - the number of rows in each chunk
+# @input index - whether to create the index over (userString, pinAttempted, time) first
+# @returns a generator of lists of at most chunk_size 4-tuples of keystroke timings,
+#           ordered by user, PIN and time
+def retrieve_data_chunks(database=DATABASE, excluded_users=EXCLUDED_USERS, chunk_size=10000, index=False):
+    if index:
+        create_index(database)
+
+    conn = sqlite3.connect(database)
+    try:
+        c = query_data(conn, excluded_users)
+        while True:
+            chunk = c.fetchmany(chunk_size)
+            if not chunk:
+                break
+            profiling.count("common.rows_read", len(chunk))
+            yield chunk
+    finally:
+        conn.close()
+
+# the moment that timestamps are counted from
+EPOCH = datetime.datetime(1970, 1, 1)
+
+##
+# This function reads one timestamp into microseconds since the epoch,
+# falling back on dateutil for anything NumPy can't read
+#
+# @input text - a timestamp (e.g. "2017-07-12 14:23:45.123456")
+# @returns the timestamp as an int of microseconds since the epoch
+def parse_timestamp(text):
+    try:
+        return int(np.datetime64(text, 'us').astype(np.int64))
+    except ValueError:
+        parsed = prsr.parse(text)
+        if parsed.utcoffset() is not None:
+            parsed = parsed.replace(tzinfo=None) - parsed.utcoffset()
+        delta = parsed - EPOCH
+        return (delta.days * 86400 + delta.seconds) * (10**6) + delta.microseconds
+
+##
+# This function reads a whole column of timestamps into microseconds since the epoch.
+# NumPy reads ISO 8601 timestamps in C all at once; only if some row is malformed
+# does the column get read row by row
+#
+# @input texts - a list of timestamps
+# @returns an int64 array of microseconds since the epoch
+def parse_timestamps(texts):
+    try:
+        return np.array(texts, dtype='datetime64[us]').astype(np.int64)
+    except ValueError:
+        return np.array([parse_timestamp(text) for text in texts], dtype=np.int64)
+
+##
+# This function converts the difference between two timestamps into an interkey timing
+#
+# @input time_a - the earlier timestamp, in microseconds
+# @input time_b - the later timestamp, in microseconds
+# @returns the time between them, in whole milliseconds
+def interkey_ms(time_a, time_b):
+    return (time_b - time_a) // (10**3)
+
 ##
 # This function organizes data by user and PIN
 #
 # @input res - a list of 4-tuples of keystroke timings
+# @input presorted - whether res is already ordered by user, PIN and time (as retrieve_data returns it),
+#                       in which case it isn't sorted again
 # @returns a dictionary of dictionaries of pairs,
 #           where the top-level dictionary connects users to all PINs they enter and
 #           the lower dictionary connects a PIN to all keystrokes used while entering the PIN and timings of each
-#           in the format of a list of pairs (key pressed, time)
-def preprocess_data(res):
+#           in the format of a list of pairs (key pressed, time), with times in microseconds since the epoch
+@profiling.timed("common.preprocess_data")
+def preprocess_data(res, presorted=False):
     keystrokes = defaultdict(lambda: defaultdict(lambda: []))
 
     # make sure data is sorted by timestamp
-    res = sorted(res, key=lambda x: x[3])
+    if not presorted:
+        res = sorted(res, key=lambda x: x[3])
+
+    # read every timestamp at once into microseconds
+    times = parse_timestamps([keystroke[3] for keystroke in res]).tolist()
 
-    # parser.parse reads a timestamp into a Python timedate object
-    for keystroke in res:
-        keystrokes[keystroke[0]][int(keystroke[1])].append((keystroke[2], prsr.parse(keystroke[3])))
+    for keystroke, time in zip(res, times):
+        keystrokes[keystroke[0]][int(keystroke[1])].append((keystroke[2], time))
 
     return keystrokes
 
 
+##
+# This function checks whether the keys of an attempt spell out the PIN it was meant to enter
+#
+# @input attempt - a list of pairs of keystrokes and timings, without the enter keystroke
+# @input pin - the PIN that was meant to be entered (as an int, which loses any leading zeroes,
+#               so PINs shorter than 4 digits are padded with zeroes to 4 digits, and longer
+#               ones have to be typed exactly)
+# @returns True if the attempt entered the PIN
+def is_correct_pin(attempt, pin):
+    # default to assuming the PIN is wrong
+    flag_incorrect = True
+    # needs try/except because some entries are "" and int("") throws an exception
+    try:
+        pin_entered = "".join([x for (x,y) in attempt])
+        flag_incorrect = not pin_entered.isdigit() or pin_entered != str(pin).zfill(4)
+    except:
+        pass
+    return not flag_incorrect
+
 ##
 # This function organizes data by individual PIN attempt,
 # while throwing out attempts that include using the clear button or are just incorrect
@@ -282,7 +495,10 @@ def preprocess_data(res):
 #           where the top-level dictionary connects users to all PINs they enter and
 #           the lower dictionary connects a PIN to all keystrokes used while entering the PIN and timings of each
 #           in the format of a list of lists of pairs [[data corresponding to entering one PIN once] ... [(key pressed, time) ...] ...]
+@profiling.timed("common.clean_data")
 def clean_data(keystrokes):
+    kept, rejected_backspace, rejected_incorrect = 0, 0, 0
+
     for user, user_data in keystrokes.items():
         for pin, pin_data in user_data.items():
             # collector for each sublist, which correspond to individual PINs
@@ -300,14 +516,7 @@ def clean_data(keystrokes):
                 if key != CODE_FOR_ENTER:
                     attempt.append((key, time))
                 else:
-                    # default to assuming the PIN is wrong
-                    flag_incorrect = True
-                    # needs try/except because some entries are "" and int("") throws an exception
-                    try:
-                        pin_entered = "".join([x for (x,y) in attempt])
-                        flag_incorrect = pin_entered != ("0000" + str(pin))[-4:]
-                    except:
-                        pass
+                    flag_incorrect = not is_correct_pin(attempt, pin)
 
                     # don't leave out the enter keystroke
                     attempt.append((key, time))
@@ -315,6 +524,11 @@ def clean_data(keystrokes):
                     # only add our PIN attempt if it is good
                     if not flag_backspace and not flag_incorrect:
                         all_attempts.append(attempt)
+                        kept += 1
+                    elif flag_backspace:
+                        rejected_backspace += 1
+                    else:
+                        rejected_incorrect += 1
                     
                     # only reset things at new PIN
                     attempt = []
@@ -322,30 +536,105 @@ def clean_data(keystrokes):
 
             keystrokes[user][pin] = all_attempts
 
+    profiling.count("common.attempts_kept", kept)
+    profiling.count("common.attempts_rejected_backspace", rejected_backspace)
+    profiling.count("common.attempts_rejected_incorrect", rejected_incorrect)
+
     return keystrokes
 
+##
+# This function does the work of preprocess_data and clean_data as a stream, keeping
+# no more than the attempt in progress for each user and PIN in memory.
+# Rows may come in any order, as long as each user's keystrokes for a PIN are in time order
+# (as retrieve_data and retrieve_data_chunks return them)
+#
+# @input chunks - an iterable of lists of 4-tuples of keystroke timings (e.g. retrieve_data_chunks())
+# @input rejected - an optional dictionary, which gets a count of every attempt thrown out
+#                   under "backspace" or "incorrect", and of attempts never finished with enter under "unfinished"
+# @returns a generator of triples of (user, PIN, attempt), where every attempt is
+#           a list of pairs of (key pressed, time), in the same format as clean_data
+def stream_clean_data(chunks, rejected=None):
+    if rejected is None:
+        rejected = {}
+    for reason in ["backspace", "incorrect", "unfinished"]:
+        rejected.setdefault(reason, 0)
+
+    # the attempt in progress for each (user, PIN), and whether it has used backspace
+    attempts = {}
+    before = dict(rejected)
+    kept = 0
+
+    for chunk in chunks:
+        times = parse_timestamps([keystroke[3] for keystroke in chunk]).tolist()
+
+        for keystroke, time in zip(chunk, times):
+            user, pin, key = keystroke[0], int(keystroke[1]), keystroke[2]
+            attempt, flag_backspace = attempts.pop((user, pin), ([], False))
+
+            # throw out any attempt that involves a backspace
+            if key == CODE_FOR_BACKSPACE:
+                flag_backspace = True
+
+            # enter is the last key pressed per PIN entry
+            if key != CODE_FOR_ENTER:
+                attempt.append((key, time))
+                attempts[(user, pin)] = (attempt, flag_backspace)
+                continue
+
+            flag_incorrect = not is_correct_pin(attempt, pin)
+
+            # don't leave out the enter keystroke
+            attempt.append((key, time))
+
+            # only pass our PIN attempt on if it is good
+            if flag_backspace:
+                rejected["backspace"] += 1
+            elif flag_incorrect:
+                rejected["incorrect"] += 1
+            else:
+                kept += 1
+                yield user, pin, attempt
+
+    rejected["unfinished"] += len([attempt for (attempt, flag_backspace) in attempts.values() if attempt])
+
+    profiling.count("common.attempts_kept", kept)
+    for reason in ["backspace", "incorrect", "unfinished"]:
+        profiling.count("common.attempts_rejected_" + reason, rejected[reason] - before[reason])
+
+##
+# This function lists every attempt of every user, whether they come from
+# clean_data or stream_clean_data
+#
+# @input keystrokes - a dictionary of dictionaries of lists of lists of pairs of keystrokes and timings,
+#                       or an iterable of triples of (user, PIN, attempt)
+# @returns an iterable of triples of (user, PIN, attempt)
+def iter_attempts(keystrokes):
+    if not hasattr(keystrokes, 'items'):
+        return keystrokes
+
+    return ((user, pin, attempt) for user, user_data in keystrokes.items()
+            for pin, pin_data in user_data.items()
+            for attempt in pin_data)
+
 ##
 # This function parses keystroke data into interkey timing data
 #
-# @input keystrokes - a dictionary of dictionaries of lists of lists of pairs of keystrokes and timings
+# @input keystrokes - a dictionary of dictionaries of lists of lists of pairs of keystrokes and timings,
+#                       or an iterable of triples of (user, PIN, attempt) such as stream_clean_data returns
 # @returns a dictionary of lists of ints,
 #           where the dictionary connects a keypair (e.g. "12")
 #           to every interkey timing used to enter it
+@profiling.timed("common.parse_data")
 def parse_data(keystrokes):
     all_timings = defaultdict(lambda: [])
 
-    for user, user_data in keystrokes.items():
-        for pin, pin_data in user_data.items():
-            entry_bigrams = []
+    for user, pin, attempt in iter_attempts(keystrokes):
+        # put every bigram of the attempt in the dictionary
+        for ((key_a, times_a), (key_b, times_b)) in zip(attempt[:-1], attempt[1:]):
+            all_timings[key_a + key_b].append(interkey_ms(times_a, times_b))
 
-            # collect every bigram from all attempts
-            for attempt in pin_data:
-                entry_bigrams.extend([(key_a + key_b, times_b - times_a) for ((key_a, times_a), (key_b, times_b)) in zip(attempt[:-1], attempt[1:])])
-
-            # put bigrams in the dictionary and convert Python timedelta objects to integers
-            for (bigram, time_diff) in entry_bigrams:
-                time_diff_in_ms = int(math.floor(((time_diff.seconds * (10**6)) + time_diff.microseconds) / (10**3)))
-                all_timings[bigram].append(time_diff_in_ms)
+    if profiling.enabled:
+        profiling.count("common.bigrams_produced", sum(len(timing) for timing in all_timings.values()))
 
     return all_timings
 
@@ -354,23 +643,31 @@ def parse_data(keystrokes):
 #
 # @input timings - a dictionary of lists of ints, where the dictionary
 #                   connects a keypair (e.g. "12") to every interkey
-#                   timing used to enter it
+#                   timing used to enter it (or a TimingStore)
 # @input percentile - the threshold above which data gets thrown out
 #                       (defaults to 95th, as in top 5% gets thrown out)
-# @returns a dictionary of lists of ints,
+# @returns a dictionary of lists of ints (or a TimingStore, if given one),
 #           where the dictionary connects keypairs (e.g. "12")
 #           to every interkey timing used to enter it (without outliers)
+@profiling.timed("common.filter_timings")
 def filter_timings(timings, percentile=95):
+    # a TimingStore filters itself with a single mask
+    if hasattr(timings, 'filtered'):
+        ret = timings.filtered(percentile)
+        profiling.count("common.timings_dropped_by_filter", timings.timings.shape[0] - ret.timings.shape[0])
+        return ret
+
     # get just the timings to figure out percentiles on them
-    just_the_timings = [timing for bigram, set_of_timings in timings.items() for timing in set_of_timings]
+    arrays = [(bigram, np.asarray(timing)) for bigram, timing in timings.items()]
+    just_the_timings = np.concatenate([np.zeros(0)] + [timing for bigram, timing in arrays])
     bar = np.percentile(just_the_timings, percentile)
 
-    # filter out all timings which fall below the threshold
-    good_pairs = [(bigram, list(filter(lambda x: x < bar, timing))) for bigram, timing in timings.items()]
+    # filter out all timings which fall below the threshold, and
+    # put our new timings back together in the dictionary
     ret = defaultdict(lambda: [])
+    for (bigram, timing) in arrays:
+        ret[bigram] = timing[timing < bar].tolist()
 
-    # put our new timings back together in the dictionary
-    for (bigram, timing) in good_pairs:
-        ret[bigram] = (timing)
+    profiling.count("common.timings_dropped_by_filter", just_the_timings.shape[0] - sum(len(timing) for timing in ret.values()))
 
     return ret
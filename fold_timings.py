@@ -0,0 +1,118 @@
+##
+# FoldTimings class that parses every user's keystrokes once, so that each
+# leave-one-user-out fold is assembled by leaving one user's timings out
+# instead of parsing everyone else's keystrokes again
+##
+from collections import defaultdict
+from common import parse_data
+from timing_store import TimingStore
+import numpy as np
+import profiling
+import math
+
+
+class FoldTimings:
+    ##
+    # Constructor that parses and sorts the timings of every user
+    #
+    # @input pin_entries_by_user - a dictionary of dictionaries of lists of lists of pairs of keystrokes and timings,
+    #                               as returned by clean_data (or a CleanedAttempts, read straight from its columns)
+    def __init__(self, pin_entries_by_user):
+        # every user's timings per keypair, in the order parse_data finds them
+        self.user_timings = {}
+        # every user's timings, sorted
+        self.user_sorted = {}
+
+        if hasattr(pin_entries_by_user, 'attempt_offsets'):
+            store = TimingStore.from_attempts(pin_entries_by_user)
+            self.users = list(store.user_names)
+            for user in self.users:
+                self.user_timings[user] = dict((bigram, timing.astype(np.int64)) for bigram, timing in store.user(user).items())
+        else:
+            self.users = list(pin_entries_by_user.keys())
+            for user in self.users:
+                timings = parse_data({user: pin_entries_by_user[user]})
+                self.user_timings[user] = dict((bigram, np.array(timing, dtype=np.int64)) for bigram, timing in timings.items())
+
+        for user in self.users:
+            self.user_sorted[user] = np.sort(np.concatenate([np.zeros(0, dtype=np.int64)] + list(self.user_timings[user].values())))
+
+        # every timing of every user, sorted; the order statistics of any fold can be found from this
+        self.all_sorted = np.sort(np.concatenate([np.zeros(0, dtype=np.int64)] + list(self.user_sorted.values())))
+
+    ##
+    # This function finds the kth smallest timing of everyone but one user,
+    # by binary searching the timings of every user
+    #
+    # @input k - the (0-based) position of the timing, once sorted
+    # @input excluded - the sorted timings of the user to leave out
+    # @returns the kth smallest timing
+    def __kth_timing(self, k, excluded):
+        low, high = 0, self.all_sorted.shape[0] - 1
+
+        # find the first timing that has more than k timings at or below it, once excluded ones are removed
+        while low < high:
+            middle = (low + high) // 2
+            value = self.all_sorted[middle]
+            rank = np.searchsorted(self.all_sorted, value, side='right') - np.searchsorted(excluded, value, side='right')
+            if rank > k:
+                high = middle
+            else:
+                low = middle + 1
+
+        return self.all_sorted[low]
+
+    ##
+    # This function finds the threshold that filter_timings would use on everyone but one user
+    #
+    # @input holdout_user - the user to leave out
+    # @input percentile - the threshold above which data gets thrown out
+    #                       (defaults to 95th, as in top 5% gets thrown out)
+    # @returns the percentile of the timings of every other user, interpolated like np.percentile
+    def cutoff(self, holdout_user, percentile=95):
+        excluded = self.user_sorted.get(holdout_user, np.zeros(0, dtype=np.int64))
+        n = self.all_sorted.shape[0] - excluded.shape[0]
+
+        index = (percentile / 100.0) * (n - 1)
+        index_below = int(math.floor(index))
+        index_above = min(index_below + 1, n - 1)
+
+        below = self.__kth_timing(index_below, excluded)
+        above = self.__kth_timing(index_above, excluded)
+        return below + (above - below) * (index - index_below)
+
+    ##
+    # This function assembles the training timings of a fold, equal to
+    # filter_timings(parse_data(...)) on the data of every other user
+    #
+    # @input holdout_user - the user to leave out
+    # @input percentile - the threshold above which data gets thrown out
+    #                       (defaults to 95th, as in top 5% gets thrown out)
+    # @returns a dictionary of lists of ints,
+    #           where the dictionary connects keypairs (e.g. "12")
+    #           to every interkey timing used to enter it (without outliers)
+    @profiling.timed("fold_timings.training_timings")
+    def training_timings(self, holdout_user, percentile=95):
+        bar = self.cutoff(holdout_user, percentile)
+
+        # go through the users in the same order parse_data would see them in a dictionary of everyone else
+        training_users = list(dict.fromkeys(user for user in self.users if user != holdout_user))
+
+        pieces = defaultdict(lambda: [])
+        for user in training_users:
+            for bigram, timing in self.user_timings[user].items():
+                pieces[bigram].append(timing)
+
+        ret = defaultdict(lambda: [])
+        dropped = 0
+        for bigram, timing in pieces.items():
+            timing = np.concatenate(timing)
+            kept = timing[timing < bar]
+            dropped += timing.shape[0] - kept.shape[0]
+            ret[bigram] = kept.tolist()
+
+        profiling.count("fold_timings.timings_dropped_by_filter", dropped)
+
+        return ret
+
+# End of file
@@ -1,13 +1,18 @@
 from common import *
 from scipy.stats import gamma
 from tree import Tree
-from model import Model
+from scorer import score_pins, rank_pins, split_rank
+from model import Model, DENSITY_BACKENDS, class_fits, set_fit_cache
+from fold_timings import FoldTimings
+from attempt_cache import CleanedAttempts, load_attempts, load_keystrokes
 from tqdm import tqdm
+from multiprocessing import Pool
+import profiling
+import argparse
 
 def generate_distribution(timings, given_set):
         # only test the keypairs we actually have data for
-        active_set = [timings[x] for x in given_set]
-        active_set = [item for sublist in active_set for item in sublist]
+        active_set = set_timings(timings, given_set)
         num_keypresses = len(active_set)
 
         # Fit a gamma distribution to the data observed
@@ -16,6 +21,9 @@ def generate_distribution(timings, given_set):
         # return the gamma distribution model of the data
         return alpha, loc, beta
 
+# the longest PINs that are ranked by scoring every PIN; longer ones are ranked with split_rank
+MAX_ENUMERATED_LENGTH = 4
+
 ##
 # This function infers PINs from a set of entries by using a model of Gamma distributions
 #
@@ -23,55 +31,171 @@ def generate_distribution(timings, given_set):
 # @input model - the Gamma distributions which predict timings
 # @returns a list of the number of guesses that it takes to guess the PINs to type
 def infer(entries, model):
-    # get all the different entries from the dictionary and separate them out to the PIN level
-    formatted_entry_list = [(e, pin) for pin, actual_entries in entries.items() for e in actual_entries]
-    res = []
-
-    for attempt, pin in tqdm(formatted_entry_list):
-        # format attempt into ms timings
-        attempt = [(time_b - time_a) for ((key_a, time_a), (key_b, time_b)) in zip(attempt[:-1], attempt[1:])]
-        attempt = [int(math.floor(((time_diff.seconds * (10**6)) + time_diff.microseconds) / (10**3))) for time_diff in attempt]
-
-        # make the guess tree of all PINs based on the probabilities suggested by our model
-        t = Tree(model, *attempt)
+    return infer_batch(entries, model).tolist()
 
-        # the tree will rank all pins by their likelihood
-        ranked_choices = t.rank_by_probability()
+##
+# This function infers PINs from a set of entries by using a model of Gamma distributions,
+# scoring every attempt at once instead of one by one
+#
+# @input entries - the timings for the PINs we want to infer, as a dictionary connecting PINs to their
+#                   attempts (one user's part of clean_data), or a CleanedAttempts read straight from its columns
+# @input model - the Gamma distributions which predict timings
+# @input batch_size - how many attempts to score at a time (bounds memory use)
+# @input max_enumerated_length - the longest PINs to rank by scoring every PIN (longer ones use split_rank)
+# @returns an array of the number of guesses that it takes to guess the PINs to type
+@profiling.timed("inference.infer_batch")
+def infer_batch(entries, model, batch_size=256, max_enumerated_length=MAX_ENUMERATED_LENGTH):
+    if not hasattr(entries, 'attempt_offsets'):
+        entries = CleanedAttempts.from_attempts(("", pin, attempt) for pin, attempts in entries.items() for attempt in attempts)
+    if len(entries) == 0:
+        return np.zeros(0, dtype=int)
+
+    # take the attempts in PIN order (and in the order they were entered, for the same PIN),
+    # so results don't depend on the order they were stored in
+    order = np.argsort(entries.attempt_pins, kind='mergesort')
+    profiling.count("inference.attempts_scored", len(entries))
+
+    # PINs of different lengths are ranked against different lists of PINs, so rank every length on its own
+    keys = np.diff(np.asarray(entries.attempt_offsets))[order]
+    res = np.empty(len(entries), dtype=int)
+    for count in np.unique(keys):
+        group = np.flatnonzero(keys == count)
+        res[group] = infer_length(entries, order[group], model, batch_size, max_enumerated_length)
 
-        just_pins = [choice[0] for choice in ranked_choices]
+    return res
 
-        # the number of guesses required is the position in this ranked list of the pin
-        res.append(just_pins.index(("0000" + str(pin))[-4:]))
+##
+# This function infers PINs from attempts that all have the same number of keys
+#
+# @input entries - a CleanedAttempts
+# @input which - an array of the indices of the attempts to infer, every one with the same number of keys
+# @input model - the Gamma distributions which predict timings
+# @input batch_size - how many attempts to score at a time (bounds memory use)
+# @input max_enumerated_length - the longest PINs to rank by scoring every PIN (longer ones use split_rank)
+# @returns an array of the number of guesses that it takes to guess the PINs to type, in the order of which
+def infer_length(entries, which, model, batch_size, max_enumerated_length):
+    # every attempt's ms timings, stacked into an (N, length) array
+    timings = entries.interkey_timings(which)
+    length = timings.shape[1]
+    pins = np.asarray(entries.attempt_pins, dtype=np.int64)[which] % (10 ** length)
+
+    # the logprob of every timing under every distance class, shaped (N, length, number of classes)
+    densities = model.log_densities(timings)
+
+    # the number of guesses required is the position of the pin in the ranked list of all PINs
+    res = np.empty(which.shape[0], dtype=int)
+    if length > max_enumerated_length:
+        # there are too many PINs to score, so only count the ones that beat each PIN
+        for i in range(which.shape[0]):
+            res[i] = split_rank(densities[i], pins[i])
+        return res
+
+    for start in range(0, which.shape[0], batch_size):
+        stop = start + batch_size
+        res[start:stop] = rank_pins(score_pins(densities[start:stop]), pins[start:stop])
 
     return res
 
-def main():
-    # get timings
-    res = retrieve_data()
-    keystrokes = preprocess_data(res)
-    pin_entries_by_user = clean_data(keystrokes)
+# every user's cleaned PIN attempts and parsed timings, shared by all folds run in this process,
+# along with the backend every fold fits and the parameters (if any) that its gamma fits start from
+fold_data = None
+fold_timings = None
+fold_backend = "gamma"
+fold_parameters = None
 
-    all_res = []
+##
+# This function hands the cleaned data to a process that runs folds,
+# so that it only has to be shipped once rather than once per fold
+#
+# @input pin_entries_by_user - the CleanedAttempts of every user
+# @input timings_by_user - the FoldTimings of the same data
+# @input profile - whether to record timers and counters while running folds
+# @input backend - the density every fold's Model fits, from DENSITY_BACKENDS
+# @input initial_parameters - the initial_parameters of every fold's Model (or None to fit from scratch)
+def init_folds(pin_entries_by_user, timings_by_user, profile=False, backend="gamma", initial_parameters=None):
+    global fold_data, fold_timings, fold_backend, fold_parameters
+    fold_data = pin_entries_by_user
+    fold_timings = timings_by_user
+    fold_backend = backend
+    fold_parameters = initial_parameters
+    if profile and not profiling.enabled:
+        profiling.enable()
 
-    for holdout_user, test_entries in tqdm(pin_entries_by_user.items()):
-        # hold out one user to test on
-        training_data = {k: v for k,v in pin_entries_by_user.items() if k != holdout_user}
-        
-        # train our model on all the rest
-        training_keypairs = parse_data(training_data)
-        training_keypairs = filter_timings(training_keypairs)
-        entry_model = Model(training_keypairs)
+##
+# This function runs one fold of leave-one-user-out cross-validation
+#
+# @input holdout_user - the user to test on, after training on everyone else
+# @returns a list of the number of guesses that it takes to guess each of the held out user's PINs
+@profiling.timed("inference.fold")
+def run_fold(holdout_user):
+    # hold out one user to test on, and train our model on all the rest
+    training_keypairs = fold_timings.training_timings(holdout_user)
+    entry_model = Model(training_keypairs, fold_backend, fold_parameters)
 
-        # attempt to do inference on the held out user's PINs
-        all_res.append(infer(test_entries, entry_model))
+    # attempt to do inference on the held out user's PINs
+    return infer(fold_data.for_user(holdout_user), entry_model)
+
+##
+# This function runs a fold and remembers which one it was, since a pool finishes them in any order
+#
+# @input indexed_user - a pair of (position of the fold, user to hold out)
+# @returns a triple of (position of the fold, result of run_fold, and what profiling recorded during the fold)
+def run_indexed_fold(indexed_user):
+    i, holdout_user = indexed_user
+    profile_before = profiling.snapshot()
+    fold_res = run_fold(holdout_user)
+    return i, fold_res, profiling.since(profile_before)
+
+def main(args):
+    if args.profile is not None:
+        profiling.enable()
+    if args.no_fit_cache:
+        set_fit_cache(None)
+
+    # get timings, as the columns of the cache rather than nested dictionaries
+    with profiling.timer("inference.load_attempts"):
+        pin_entries_by_user = load_attempts()
+
+    # results are reported in user order, no matter what order the data came in
+    users = sorted(str(user) for user in pin_entries_by_user.user_names)
+
+    # parse every user's timings once, rather than once per fold they are trained on
+    with profiling.timer("inference.FoldTimings"):
+        timings_by_user = FoldTimings(pin_entries_by_user)
+
+    # seed every fold's fits with a fit of all users, which every fold only differs slightly from
+    initial_parameters = None
+    if args.warm_start:
+        with profiling.timer("inference.warm_start"):
+            initial_parameters = class_fits(timings_by_user.training_timings(None))
+
+    all_res = [None] * len(users)
+
+    if args.jobs > 1:
+        pool = Pool(args.jobs, initializer=init_folds,
+                    initargs=(pin_entries_by_user, timings_by_user, profiling.enabled, args.model, initial_parameters))
+        try:
+            # collect folds as they finish so progress stays accurate, but keep them in user order
+            for i, fold_res, fold_profile in tqdm(pool.imap_unordered(run_indexed_fold, enumerate(users)), total=len(users)):
+                all_res[i] = fold_res
+                profiling.merge(fold_profile)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_folds(pin_entries_by_user, timings_by_user, backend=args.model, initial_parameters=initial_parameters)
+        for i, holdout_user in enumerate(tqdm(users)):
+            all_res[i] = run_fold(holdout_user)
 
     with change_stdout('new.out'):
         print all_res
 
+    if args.profile is not None:
+        profiling.write_report(args.profile, {"jobs": args.jobs, "model": args.model, "warm_start": args.warm_start})
+        print "profile written to " + args.profile
+
 def test():
-    res = retrieve_data()
-    keystrokes = preprocess_data(res)
-    pin_entries_by_user = clean_data(keystrokes)
+    pin_entries_by_user = load_keystrokes()
     training_keypairs = parse_data(pin_entries_by_user)
     training_keypairs = filter_timings(training_keypairs)
     entry_model = Model(training_keypairs)
@@ -89,4 +213,18 @@ def test():
     with change_stdout("hi.out"):
         print t.rank_by_probability()
 
-main()
+# python inference.py [--jobs N] [--model {gamma,histogram,kde}] [--warm_start] [--no_fit_cache] [--profile [FILE]]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Specify arguments')
+    parser.add_argument('--jobs', help='number of processes to run folds on', type=int, default=1)
+    parser.add_argument('--model', help='density fit to the timings of every set (default gamma)',
+                        choices=sorted(DENSITY_BACKENDS.keys()), default="gamma")
+    parser.add_argument('--warm_start', help='start every fold\'s gamma fits from a fit of all users', action="store_true")
+    parser.add_argument('--no_fit_cache', help='fit every gamma again rather than reusing fits kept from earlier runs', action="store_true")
+    parser.add_argument('--profile', help='write timers and counters of the run to a JSON file (default profile.json)',
+                        nargs='?', const='profile.json', default=None)
+    args = parser.parse_args()
+    if args.warm_start and args.model != "gamma":
+        parser.error("--warm_start only applies to --model gamma")
+
+    main(args)
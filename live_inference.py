@@ -0,0 +1,178 @@
+##
+# Live inference, which updates the most likely PINs after every keystroke of
+# many PIN entries at once, read as JSON lines from stdin or a local socket
+##
+from common import *
+from model import build_model
+from session import Session
+from collections import deque
+import numpy as np
+import asyncore
+import asynchat
+import socket
+import argparse
+import json
+import time
+import sys
+
+# how many of the latest event latencies the median and 99th percentile are taken over
+LATENCY_WINDOW = 10000
+
+# how long the latest events took to handle, in ms
+latencies = deque(maxlen=LATENCY_WINDOW)
+
+# the count, sum and max of the latencies of every event handled, in ms
+latency_totals = {"events": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+##
+# @input value - a timestamp, either in microseconds since the epoch or as text (as in the database)
+# @returns the timestamp in microseconds since the epoch
+def event_time(value):
+    if isinstance(value, (int, long)):
+        return value
+    return parse_timestamp(value)
+
+##
+# This function handles one keystroke event, such as
+# {"session": "atm-1", "key": "4", "time": "2017-07-12 14:03:11.482000"}
+#
+# @input sessions - a dictionary connecting session names to their Session
+# @input line - the event as a line of JSON
+# @input model - the model which predicts timings
+# @input top - the number of candidates to report
+# @input length - the most digits a PIN can have
+# @returns a line of JSON with the best candidates of the session after the event,
+#           and how long it took to get them
+def handle_event(sessions, line, model, top, length):
+    received = time.time()
+
+    try:
+        event = json.loads(line)
+        name, key, when = event["session"], str(event["key"]), event_time(event["time"])
+        if key not in key_index and key != CODE_FOR_BACKSPACE:
+            raise ValueError("not a key on the keypad: " + key)
+    except (ValueError, KeyError, TypeError) as e:
+        return json.dumps({"error": "bad event: " + str(e)})
+
+    if name not in sessions:
+        sessions[name] = Session(model, length)
+    session = sessions[name]
+
+    complete = session.press(key, when)
+    reply = {
+        "session": name,
+        "key": key,
+        "digits": session.digits,
+        "complete": complete,
+        "candidates": session.top(top)
+    }
+
+    # a finished entry needs no more state; its next keystroke starts a new session
+    if complete:
+        del sessions[name]
+
+    reply["latency_ms"] = (time.time() - received) * 1000
+    latencies.append(reply["latency_ms"])
+    latency_totals["events"] += 1
+    latency_totals["total_ms"] += reply["latency_ms"]
+    latency_totals["max_ms"] = max(latency_totals["max_ms"], reply["latency_ms"])
+    return json.dumps(reply)
+
+##
+# @returns a dictionary of the count, mean and max of the latencies of every event, and the median
+#           and 99th percentile of the latest LATENCY_WINDOW of them, in ms
+def latency_summary():
+    if latency_totals["events"] == 0:
+        return {"events": 0}
+
+    recent = np.array(latencies)
+    return {
+        "events": latency_totals["events"],
+        "mean_ms": latency_totals["total_ms"] / latency_totals["events"],
+        "median_ms": float(np.percentile(recent, 50)),
+        "p99_ms": float(np.percentile(recent, 99)),
+        "max_ms": latency_totals["max_ms"]
+    }
+
+##
+# This function handles events from stdin, one line at a time, until stdin closes
+#
+# @input model - the model which predicts timings
+# @input top - the number of candidates to report
+# @input length - the most digits a PIN can have
+def serve_stdin(model, top, length):
+    sessions = {}
+
+    # readline rather than iterating, which would wait for a whole buffer of events
+    for line in iter(sys.stdin.readline, ""):
+        if line.strip():
+            print handle_event(sessions, line, model, top, length)
+            sys.stdout.flush()
+
+
+class EventChannel(asynchat.async_chat):
+    ##
+    # Constructor for a connection that sends events, whose sessions are kept apart from other connections
+    def __init__(self, sock, model, top, length):
+        asynchat.async_chat.__init__(self, sock)
+        self.set_terminator("\n")
+        self.incoming = []
+        self.sessions = {}
+        self.model = model
+        self.top = top
+        self.length = length
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        line = "".join(self.incoming)
+        self.incoming = []
+        if line.strip():
+            self.push(handle_event(self.sessions, line, self.model, self.top, self.length) + "\n")
+
+
+class EventServer(asyncore.dispatcher):
+    ##
+    # Constructor for a server that listens for connections on the local machine
+    def __init__(self, port, model, top, length):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(("127.0.0.1", port))
+        self.listen(128)
+        self.model = model
+        self.top = top
+        self.length = length
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            EventChannel(pair[0], self.model, self.top, self.length)
+
+##
+# Fit the model, then handle events until stdin closes (or the server is interrupted)
+def main(args):
+    model = build_model(args.database)
+
+    if args.port is None:
+        serve_stdin(model, args.top, args.length)
+    else:
+        EventServer(args.port, model, args.top, args.length)
+        try:
+            asyncore.loop()
+        except KeyboardInterrupt:
+            pass
+
+    print >>sys.stderr, json.dumps(latency_summary())
+
+# python live_inference.py [--port PORT] [--top K] [--length N] [--database DB]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Specify arguments')
+    parser.add_argument('--port', help='port on the local machine to take events on (default is to read stdin)', type=int, default=None)
+    parser.add_argument('--top', help='number of candidates to report after every event', type=int, default=10)
+    parser.add_argument('--length', help='most digits a PIN can have', type=int, default=4)
+    parser.add_argument('--database', help='database to fit the model on', default=DATABASE)
+    args = parser.parse_args()
+
+    main(args)
@@ -2,61 +2,445 @@
 # Model class that calculates probabilities given timings
 
 from common import *
+from attempt_cache import load_keystrokes
+from collections import OrderedDict
 from scipy.stats import gamma
-from math import log
+import numpy as np
+import profiling
+import tempfile
+import hashlib
+import scipy
+import json
+import time
+
+# the most milliseconds a log-density table covers, so that a stray long timing
+# can't blow up the table; timings past the table are evaluated directly
+MAX_TABLE_MS = 60000
+
+# the width of the bins of the histogram backend, in ms
+HISTOGRAM_BIN_MS = 10
+
+# how many timings every bin of the histogram backend is assumed to have on top of the ones it has,
+# so that a timing in an empty bin is unlikely rather than impossible
+HISTOGRAM_SMOOTHING = 1.0
+
+# the standard deviation of the Gaussian kernel of the kde backend, in ms
+KDE_BANDWIDTH_MS = 10.0
+
+# how many bandwidths out the kde backend spreads every timing over its grid; anywhere the
+# timings left past that could matter is evaluated exactly instead
+KDE_CUTOFF = 8
+
+# how many (timing, distinct timing) terms the kde backend sums at a time when evaluating exactly,
+# so that evaluating many timings against many distinct ones stays in bounded memory
+KDE_EXACT_CHUNK = 1 << 20
+
+# how many fits to remember in memory, least recently used first out
+FIT_CACHE_SIZE = 256
+
+# the directory fits are kept in between runs, one file per fit (None to only remember them in memory)
+FIT_CACHE_DIR = "gamma_fits.cache"
+
+# fits already performed, keyed by fit_key, along with how long each took
+fit_cache = OrderedDict()
+fit_cache_dir = FIT_CACHE_DIR
+
+##
+# This function picks where fits are remembered between runs, forgetting every fit remembered in memory
+#
+# @input path - the directory to keep fits in, or None to only remember them in memory
+def set_fit_cache(path):
+    global fit_cache_dir
+    fit_cache_dir = path
+    fit_cache.clear()
+
+##
+# This function names a fit by what it was fit to. The data is sorted first, so the same
+# timings always get the same key, and so the same fit, in whatever order they were collected
+#
+# @input data - a sorted array of timings
+# @input initial - the (alpha, loc, beta) the fit starts from, or None
+# @returns a hex digest of the data, the starting point and the version of scipy that fits them
+def fit_key(data, initial):
+    digest = hashlib.sha1(data.tobytes())
+    digest.update(repr((None if initial is None else tuple(float(x) for x in initial), scipy.__version__)).encode())
+    return digest.hexdigest()
+
+##
+# This function looks a fit up, in memory and then on disk
+#
+# @input key - the fit_key of the fit
+# @returns a pair of the (alpha, loc, beta) and how many seconds the fit took, or None if it was never remembered
+def cached_fit(key):
+    if key in fit_cache:
+        fit_cache[key] = fit_cache.pop(key)
+        return fit_cache[key]
+    if fit_cache_dir is None:
+        return None
+
+    try:
+        with open(os.path.join(fit_cache_dir, key + ".json")) as f:
+            saved = json.load(f)
+        fit = tuple(saved["parameters"]), saved["seconds"]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+    remember_in_memory(key, fit)
+    return fit
+
+##
+# This function remembers a fit in memory, forgetting the least recently used fit past FIT_CACHE_SIZE
+#
+# @input key - the fit_key of the fit
+# @input fit - a pair of the (alpha, loc, beta) and how many seconds the fit took
+def remember_in_memory(key, fit):
+    fit_cache[key] = fit
+    while len(fit_cache) > FIT_CACHE_SIZE:
+        fit_cache.popitem(last=False)
+
+##
+# This function remembers a fit, in memory and on disk. Every fit is written to its own
+# file and renamed into place, so processes fitting at once never see one half-written
+#
+# @input key - the fit_key of the fit
+# @input fit - a pair of the (alpha, loc, beta) and how many seconds the fit took
+def remember_fit(key, fit):
+    remember_in_memory(key, fit)
+    if fit_cache_dir is None:
+        return
+
+    # if the directory can't be written, the fit is still remembered in memory
+    try:
+        if not os.path.isdir(fit_cache_dir):
+            os.makedirs(fit_cache_dir)
+    except OSError:
+        # another process may have made it first
+        pass
+    try:
+        handle, temp_path = tempfile.mkstemp(prefix=key + ".", suffix=".tmp", dir=fit_cache_dir)
+    except (IOError, OSError):
+        return
+
+    try:
+        with os.fdopen(handle, 'w') as f:
+            json.dump({"parameters": [float(x) for x in fit[0]], "seconds": fit[1]}, f)
+        os.rename(temp_path, os.path.join(fit_cache_dir, key + ".json"))
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+##
+# This function fits a gamma distribution to a set of timings, remembering the result so
+# that the same timings (from the same starting point) never get fit twice
+#
+# @input timings - a list of timings
+# @input initial - an optional (alpha, loc, beta) to start the fit from, such as the
+#                   fit of a similar set of timings (which can land on a slightly different fit)
+# @returns the fitted (alpha, loc, beta)
+def fit_gamma(timings, initial=None):
+    # the optimizer is sensitive to the order of the data, so always fit it
+    # sorted, to get the same fit no matter what order timings were collected in
+    data = np.sort(np.asarray(timings, dtype=float))
+    key = fit_key(data, initial)
+
+    fit = cached_fit(key)
+    if fit is not None:
+        profiling.count("model.gamma_fit_cache_hits")
+        profiling.count("model.gamma_fit_seconds_saved", fit[1])
+        return fit[0]
+
+    start = time.time()
+    with profiling.timer("model.fit_gamma"):
+        if initial is None:
+            res = gamma.fit(data)
+        else:
+            res = gamma.fit(data, initial[0], loc=initial[1], scale=initial[2])
+    profiling.count("model.gamma_fits")
+
+    remember_fit(key, (tuple(res), time.time() - start))
+    return tuple(res)
+
+##
+# This function makes the log density of a set with no timings, under which every timing is impossible
+#
+# @returns a function from an array of timings to an array of -inf
+def empty_density():
+    return lambda timings: np.full(np.shape(timings), -float('inf'))
+
+##
+# This function fits a gamma distribution to the timings of a set
+#
+# @input timings - a list of timings
+# @input initial - an optional (alpha, loc, beta) to start the fit from (see fit_gamma)
+# @returns a function from an array of timings to their logprobs
+def gamma_density(timings, initial=None):
+    parameters = fit_gamma(timings, initial)
+    distribution = gamma(parameters[0], loc=parameters[1], scale=parameters[2])
+
+    # a density of zero is an impossible timing, which gets a logprob of -inf
+    def log_density(timings):
+        with np.errstate(divide='ignore'):
+            return np.log(distribution.pdf(timings))
+
+    return log_density
+
+##
+# This function fits a histogram to the timings of a set, in one pass over them. Every
+# bin gets HISTOGRAM_SMOOTHING extra timings. Past the last bin the density falls off
+# exponentially from that bin's, with the mean of the timings as its scale, and the
+# bins and the tail are normalized together so the density integrates to 1
+#
+# @input timings - a list of timings
+# @returns a function from an array of timings to their logprobs (-inf for negative timings)
+def histogram_density(timings):
+    data = np.asarray(timings, dtype=np.int64)
+    data = data[data >= 0]
+    if data.shape[0] == 0:
+        return empty_density()
+
+    counts = np.bincount(data // HISTOGRAM_BIN_MS) + HISTOGRAM_SMOOTHING
+    end = counts.shape[0] * HISTOGRAM_BIN_MS
+    scale = max(np.mean(data), float(HISTOGRAM_BIN_MS))
+
+    # the tail starts at the density of the last bin, so it holds that bin's mass for every bin width of scale
+    tail = counts[-1] * scale / HISTOGRAM_BIN_MS
+    total = (counts.sum() + tail) * float(HISTOGRAM_BIN_MS)
+    log_densities = np.log(counts / total)
+
+    def log_density(timings):
+        timings = np.asarray(timings, dtype=float)
+        flat = timings.reshape(-1)
+        bins = np.floor(flat / HISTOGRAM_BIN_MS)
+
+        res = log_densities[-1] - (flat - end) / scale
+        inside = (bins >= 0) & (bins < counts.shape[0])
+        res[inside] = log_densities[bins[inside].astype(np.int64)]
+        res[flat < 0] = -float('inf')
+        res[np.isnan(flat)] = np.nan
+        return res.reshape(timings.shape)
+
+    return log_density
+
+##
+# This function fits a Gaussian kernel density estimate with a fixed bandwidth to the timings of a set.
+# The timings are counted per ms in one pass, and the counts are spread over a grid of every ms
+# with a kernel that stops KDE_CUTOFF bandwidths out; wherever that leaves too little to trust, or for timings
+# off the grid, the density is evaluated exactly (in log space, so far off timings don't come out impossible)
+#
+# @input timings - a list of timings
+# @returns a function from an array of timings to their logprobs
+def kde_density(timings):
+    data = np.asarray(timings, dtype=np.int64)
+    data = data[data >= 0]
+    if data.shape[0] == 0:
+        return empty_density()
+
+    bandwidth = KDE_BANDWIDTH_MS
+    radius = int(np.ceil(KDE_CUTOFF * bandwidth))
+    counts = np.bincount(data)
+
+    # the exact log density, summed over every distinct timing
+    values = np.flatnonzero(counts)
+    weights = np.log(counts[values])
+    norm = np.log(data.shape[0] * bandwidth * np.sqrt(2 * np.pi))
+
+    def exact(timings):
+        res = np.empty(timings.shape)
+        step = max(1, KDE_EXACT_CHUNK // values.shape[0])
+        for start in range(0, timings.shape[0], step):
+            chunk = timings[start:start + step]
+            terms = weights[np.newaxis, :] - 0.5 * ((chunk[:, np.newaxis] - values[np.newaxis, :]) / bandwidth) ** 2
+            top = terms.max(axis=1)
+            res[start:start + step] = top + np.log(np.exp(terms - top[:, np.newaxis]).sum(axis=1)) - norm
+        return res
+
+    # grid[i] is the density at i - radius ms
+    offsets = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2) / np.exp(norm)
+    grid = np.convolve(counts, kernel)
+    log_grid = np.empty(grid.shape)
+    # the timings cut off from a grid point add at most kernel[0] each, so only trust points far above that
+    reached = grid > data.shape[0] * kernel[0] * 1e9
+    log_grid[reached] = np.log(grid[reached])
+    log_grid[~reached] = exact(np.flatnonzero(~reached).astype(float) - radius)
+
+    def log_density(timings):
+        timings = np.asarray(timings, dtype=float)
+        flat = timings.reshape(-1)
+        index = flat + radius
+
+        res = np.empty(flat.shape)
+        on_grid = (flat == np.floor(flat)) & (index >= 0) & (index < log_grid.shape[0])
+        res[on_grid] = log_grid[index[on_grid].astype(np.int64)]
+        res[~on_grid] = exact(flat[~on_grid])
+        return res.reshape(timings.shape)
+
+    return log_density
+
+##
+# This function fits a gamma distribution to every distance class, such as to
+# start the fits of models of similar timings from
+#
+# @input keypairs - a dictionary of lists of ints,
+#                   where the dictionary connects a keypair (e.g. "12")
+#                   to every interkey timing used to enter it
+# @returns a list of the (alpha, loc, beta) of every set in distance_classes
+def class_fits(keypairs):
+    return [fit_gamma(active_set) for active_set in class_timings(keypairs)]
+
+# every density a Model can fit to its sets, by name
+DENSITY_BACKENDS = {
+    "gamma": gamma_density,
+    "histogram": histogram_density,
+    "kde": kde_density
+}
 
 class Model:
     ##
     # Constructor for model that takes in keypairs and automatically generates
-    # the gamma distributions and set probabilities for them.
+    # the distributions (gamma, unless another backend is picked) and set probabilities for them.
     #
     # @input keypairs - a dictionary of lists of ints,
     #                   where the dictionary connects a keypair (e.g. "12")
     #                   to every interkey timing used to enter it
-    def __init__(self, keypairs):
-        self.__distributions = defaultdict(lambda: None)
-        self.__set_probabilities = defaultdict(lambda: 0.0)
+    # @input backend - the name of the density to fit to every set, from DENSITY_BACKENDS
+    # @input initial_parameters - an optional list of (alpha, loc, beta) per set in distance_classes to
+    #                   start each gamma fit from, such as the class_fits of similar timings
+    @profiling.timed("model.Model")
+    def __init__(self, keypairs, backend="gamma", initial_parameters=None):
+        if backend not in DENSITY_BACKENDS:
+            raise ValueError("unknown density backend: " + str(backend))
+        if initial_parameters is not None and backend != "gamma":
+            raise ValueError("only gamma fits can start from initial parameters")
+
+        # all are indexed by the position of a set in distance_classes
+        self.__densities = [None] * len(distance_classes)
+        self.__set_probabilities = [0.0] * len(distance_classes)
+        self.backend = backend
         total = 0
-        
-        for set_name in list_of_lists["model_sets"]:
-            self.__distributions[set_name], num_keypresses = self.__generate_distribution(keypairs, all_sets[set_name])
-            self.__set_probabilities[set_name] = float(num_keypresses)
+
+        # every timing of every class, grouped in one pass through distance_class_table
+        for class_id, active_set in enumerate(class_timings(keypairs)):
+            initial = None if initial_parameters is None else initial_parameters[class_id]
+            self.__densities[class_id], num_keypresses = self.__generate_distribution(active_set, initial)
+            self.__set_probabilities[class_id] = float(num_keypresses)
             total += num_keypresses
 
-        for key in self.__set_probabilities:
-            self.__set_probabilities[key] = self.__set_probabilities[key] / total
-   
+        for class_id in range(len(distance_classes)):
+            self.__set_probabilities[class_id] = self.__set_probabilities[class_id] / total
+
+        self.__build_table(keypairs)
+
     ##
-    # This function produces an individual gamma distribution for a given set
+    # This function evaluates every distribution at every integer millisecond from 0
+    # up to the longest timing observed, so that scoring a timing is a lookup
     #
-    # @input timings - the set of all timings
-    # @input given_set - the set to produce a distribution for
+    # @input keypairs - the timings the model was built from
+    def __build_table(self, keypairs):
+        longest = max([max(timing) for timing in keypairs.values() if len(timing) > 0] or [0])
+        grid = np.arange(0, min(int(longest), MAX_TABLE_MS) + 1, dtype=float)
+
+        self.__table = np.vstack([self.__log_density(class_id, grid) for class_id in range(len(distance_classes))])
+
+    ##
+    # This function evaluates the logprob of timings under the distribution of a set directly
     #
-    # @returns the distribution for that set and the number of keypresses seen in that set
-    def __generate_distribution(self, timings, given_set):
-        # only test the keypairs we actually have data for
-        active_set = [timings[x] for x in given_set]
-        active_set = [item for sublist in active_set for item in sublist]
-        num_keypresses = len(active_set)
+    # @input class_id - the position of the set in distance_classes
+    # @input timings - a timing or an array of timings
+    #
+    # @returns the logprob of every timing, where timings the distribution can't produce get -inf
+    def __log_density(self, class_id, timings):
+        return self.__densities[class_id](timings)
 
-        # Fit a gamma distribution to the data observed
-        alpha, loc, beta = gamma.fit(active_set)
+    ##
+    # This function finds which timings can be looked up in the table
+    #
+    # @input timings - an array of timings
+    #
+    # @returns a boolean array of the timings within the table, and an array of their columns in it
+    def __table_columns(self, timings):
+        columns = np.zeros(timings.shape, dtype=np.int64)
+        in_table = (timings >= 0) & (timings < self.__table.shape[1]) & (timings == np.floor(timings))
+        columns[in_table] = timings[in_table]
+        return in_table, columns
+   
+    ##
+    # This function produces an individual distribution for a given set, with the backend of the model
+    #
+    # @input active_set - an array of every timing of the set
+    # @input initial - the (alpha, loc, beta) to start a gamma fit from, or None
+    #
+    # @returns the log density function of the distribution for that set,
+    #           and the number of keypresses seen in that set
+    def __generate_distribution(self, active_set, initial=None):
+        num_keypresses = active_set.shape[0]
 
-        # return the gamma distribution model of the data
-        return gamma(alpha, loc=loc, scale=beta), num_keypresses
+        # Fit a distribution to the data observed
+        if initial is not None:
+            return gamma_density(active_set, initial), num_keypresses
+        return DENSITY_BACKENDS[self.backend](active_set), num_keypresses
 
     ##
     # This function gives the logprob of a keypress being in a particular set
     # given that we observed a given timing
     #
     # @input trial_set - the set whose distribution we want to test with
+    #                       (a name from distance_classes)
     # @input timing - the timing we are testing
     #
     # @returns the logprob of this conditional event
     def probability(self, trial_set, timing):
-        res = -float('inf')
-        try:
-            res = log(self.__distributions[trial_set].pdf(timing))
-        except:
-            pass
+        class_id = distance_class_ids.get(trial_set, -1)
+        if class_id < 0:
+            return -float('inf')
+
+        if 0 <= timing < self.__table.shape[1] and timing == int(timing):
+            return float(self.__table[class_id, int(timing)])
+        return float(self.__log_density(class_id, timing))
+
+    ##
+    # This function gives the logprobs of many keypresses being in a particular set
+    # given the timings we observed, all in one call
+    #
+    # @input trial_set - the set whose distribution we want to test with
+    #                       (a name from distance_classes)
+    # @input timings - an array of the timings we are testing
+    #
+    # @returns an array of the logprobs of these conditional events, shaped like timings
+    def probabilities(self, trial_set, timings):
+        timings = np.asarray(timings, dtype=float)
+        class_id = distance_class_ids.get(trial_set, -1)
+        if class_id < 0:
+            return np.full(timings.shape, -float('inf'))
+
+        in_table, columns = self.__table_columns(timings)
+        res = self.__table[class_id, columns]
+        if not in_table.all():
+            res[~in_table] = self.__log_density(class_id, timings[~in_table])
+        return res
+
+    ##
+    # This function gives the logprobs of many keypresses under every set at once
+    #
+    # @input timings - an array of the timings we are testing
+    #
+    # @returns an array of the logprobs, shaped like timings with an extra last axis
+    #           that follows the order of distance_classes
+    def log_densities(self, timings):
+        timings = np.asarray(timings, dtype=float)
+
+        in_table, columns = self.__table_columns(timings)
+        res = np.moveaxis(self.__table[:, columns], 0, -1)
+        if not in_table.all():
+            res[~in_table] = np.stack([self.__log_density(class_id, timings[~in_table])
+                                       for class_id in range(len(distance_classes))], axis=-1)
         return res
+
+##
+# This function fits a model on every user in a database, such as the one every
+# live session or list of candidates is scored with
+#
+# @input database - the path of the SQLite database
+# @returns a Model of the timings of every user
+def build_model(database=DATABASE):
+    return Model(filter_timings(parse_data(load_keystrokes(database))))
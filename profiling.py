@@ -0,0 +1,170 @@
+##
+# Named timers and counters for finding out where a run spends its time. Everything
+# here does nothing until enable() is called, so the hooks can stay in place for good
+##
+from contextlib import contextmanager
+import functools
+import json
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# whether anything gets recorded
+enabled = False
+
+# when recording started
+started = None
+
+# how many of everything were counted, by name
+counters = {}
+
+# how long everything took, by name, as dictionaries of the total seconds, the number of calls and the longest call
+timers = {}
+
+##
+# This function starts recording
+#
+# @input track_memory - whether to trace the peak memory used, with tracemalloc where there is one
+def enable(track_memory=True):
+    global enabled, started
+    enabled = True
+    started = time.time()
+
+    if track_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+##
+# This function adds to a counter, if recording
+#
+# @input name - the name of the counter
+# @input amount - how much to add
+def count(name, amount=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + amount
+
+##
+# This function adds a length of time to a timer
+#
+# @input name - the name of the timer
+# @input seconds - how long the call took
+def add_time(name, seconds):
+    entry = timers.setdefault(name, {"seconds": 0.0, "calls": 0, "longest_seconds": 0.0})
+    entry["seconds"] += seconds
+    entry["calls"] += 1
+    entry["longest_seconds"] = max(entry["longest_seconds"], seconds)
+
+##
+# This function times whatever runs inside of it, if recording
+#
+# @input name - the name of the timer
+@contextmanager
+def timer(name):
+    if not enabled:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+##
+# This function makes a decorator that times every call of a function, if recording
+#
+# @input name - the name of the timer
+# @returns a decorator
+def timed(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+##
+# @returns a copy of the counters and timers, which can be sent between processes
+def snapshot():
+    return {
+        "counters": dict(counters),
+        "timers": dict((name, dict(entry)) for name, entry in timers.items())
+    }
+
+##
+# This function finds what was recorded after an earlier snapshot, such as over one fold
+#
+# @input before - an earlier snapshot
+# @returns a snapshot of only what was recorded since
+def since(before):
+    now = snapshot()
+
+    delta_counters = dict((name, value - before["counters"].get(name, 0)) for name, value in now["counters"].items())
+    delta_timers = {}
+    for name, entry in now["timers"].items():
+        old = before["timers"].get(name, {"seconds": 0.0, "calls": 0})
+        if entry["calls"] > old["calls"]:
+            # the longest call can't be split up, so it stays the longest seen by this process
+            delta_timers[name] = {
+                "seconds": entry["seconds"] - old["seconds"],
+                "calls": entry["calls"] - old["calls"],
+                "longest_seconds": entry["longest_seconds"]
+            }
+
+    return {"counters": delta_counters, "timers": delta_timers}
+
+##
+# This function adds the recordings of another process (such as a worker of a pool) to this one's
+#
+# @input other - a snapshot from the other process
+def merge(other):
+    for name, value in other["counters"].items():
+        counters[name] = counters.get(name, 0) + value
+
+    for name, other_entry in other["timers"].items():
+        entry = timers.setdefault(name, {"seconds": 0.0, "calls": 0, "longest_seconds": 0.0})
+        entry["seconds"] += other_entry["seconds"]
+        entry["calls"] += other_entry["calls"]
+        entry["longest_seconds"] = max(entry["longest_seconds"], other_entry["longest_seconds"])
+
+##
+# @returns a dictionary of the peak memory used, from tracemalloc (if tracing) and from the OS
+def memory():
+    res = {}
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        res["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+    if resource is not None:
+        # Linux reports the peak resident size in kilobytes
+        res["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return res
+
+##
+# @input extra - a dictionary of anything else to put in the report
+# @returns a dictionary of everything recorded
+def report(extra=None):
+    res = snapshot()
+    res["wall_seconds"] = time.time() - started if started is not None else 0.0
+    res["memory"] = memory()
+    res.update(extra or {})
+    return res
+
+##
+# This function writes everything recorded to a file, as JSON
+#
+# @input path - the file to write
+# @input extra - a dictionary of anything else to put in the report
+def write_report(path, extra=None):
+    with open(path, 'w') as f:
+        json.dump(report(extra), f, indent=2, sort_keys=True)
+
+# End of file
@@ -0,0 +1,393 @@
+##
+# Scorer class that scores every possible PIN for a set of interkey timings
+# at once, as a vectorized replacement for building a Tree
+##
+import numpy as np
+import heapq
+from common import CODE_FOR_ENTER, distance_classes, distance_class_table, key_index
+
+# every distance class the model knows about, in a fixed order
+MODEL_SETS = distance_classes
+
+# cache of the PIN-by-level distance class matrices, keyed by PIN length
+_pin_class_cache = {}
+
+
+##
+# This function computes the distance class index (into MODEL_SETS) of every
+# level of every PIN of a given length. It follows the layout of the Tree:
+# the first level pairs the first digit with the enter key and every later
+# level pairs a digit with the one before it
+#
+# @input length - the number of digits in a PIN
+# @returns a (10**length, length) array of class indices, where row n
+#           belongs to the PIN str(n) padded with zeroes
+def pin_classes(length):
+    if length not in _pin_class_cache:
+        # as in Distance, each level looks up the keypair (digit, parent digit)
+        digits = pin_digits(length)
+        classes = np.empty(digits.shape, dtype=np.intp)
+        classes[:, 0] = distance_class_table[digits[:, 0], key_index[CODE_FOR_ENTER]]
+        for level in range(1, length):
+            classes[:, level] = distance_class_table[digits[:, level], digits[:, level - 1]]
+
+        _pin_class_cache[length] = classes
+
+    return _pin_class_cache[length]
+
+
+##
+# This function splits every PIN of a given length into its digits
+#
+# @input length - the number of digits in a PIN
+# @returns a (10**length, length) array, where row n holds the digits of str(n) padded with zeroes
+def pin_digits(length):
+    pins = np.arange(10 ** length)
+    powers = 10 ** np.arange(length - 1, -1, -1)
+    return (pins[:, np.newaxis] // powers) % 10
+
+
+##
+# This function formats a PIN index as the PIN string it stands for
+#
+# @input index - the row of the PIN in the score array
+# @input length - the number of digits in a PIN
+# @returns the PIN padded with zeroes (e.g. 12 -> "0012")
+def pin_string(index, length):
+    return str(index).zfill(length)
+
+
+##
+# This function sums the logprobs of the distance class of every level of
+# every PIN, for one or many attempts at once
+#
+# @input densities - an array shaped (..., length, len(MODEL_SETS)), holding
+#                       the logprob of each timing under each distance class
+# @returns an array shaped (..., 10**length) of the score of every PIN
+def score_pins(densities):
+    densities = np.asarray(densities, dtype=float)
+    length = densities.shape[-2]
+    classes = pin_classes(length)
+
+    # accumulate level by level from 1, exactly like the probabilities of a Tree
+    scores = np.ones(densities.shape[:-2] + (classes.shape[0],))
+    for level in range(length):
+        scores += densities[..., level, classes[:, level]]
+    return scores
+
+
+##
+# This function extends the scores of every PIN prefix by one more digit, so
+# that PINs can be scored a timing at a time as they are typed. Extending from
+# nothing, one timing at a time, adds up to exactly what score_pins gives
+#
+# @input scores - an array of the 10**level scores of every prefix of level digits,
+#                   or None if no timing has been scored yet
+# @input densities - an array of the logprob of the next timing under each distance class
+# @returns an array of the 10**(level + 1) scores of every prefix one digit longer
+def extend_scores(scores, densities):
+    densities = np.asarray(densities, dtype=float)
+    if scores is None:
+        return 1 + densities[distance_class_table[:10, key_index[CODE_FOR_ENTER]]]
+
+    # transitions[parent, digit] is the logprob of digit following parent; as in
+    # Distance, this looks up the keypair (digit, parent digit)
+    transitions = densities[distance_class_table[:10, :10].T]
+    return (scores[:, np.newaxis] + transitions[np.arange(scores.shape[0]) % 10]).ravel()
+
+
+##
+# This function finds the k highest scores without sorting every score. Equal
+# scores are taken in ascending order, as in rank_pins
+#
+# @input scores - an array of the score of every PIN
+# @input k - the number of PINs to return
+# @returns an array of the indices of the k best PINs, best first
+def top_pins(scores, k):
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+
+    # find the kth best score, then keep everything above it and fill up
+    # with the lowest PINs that tie with it
+    threshold = scores[np.argpartition(-scores, k - 1)[k - 1]]
+    above = np.flatnonzero(scores > threshold)
+    ties = np.flatnonzero(scores == threshold)[:k - above.shape[0]]
+    chosen = np.concatenate((above, ties))
+
+    return chosen[np.lexsort((chosen, -scores[chosen]))]
+
+
+##
+# This function finds where PINs fall when their scores are ranked from highest
+# to lowest. PINs that score the same are ranked in ascending order, which is
+# the order that both Tree and Scorer.rank_by_probability use
+#
+# @input scores - an array shaped (n, 10**length) of PIN scores for n attempts
+# @input pins - an array of n PIN indices, one per attempt
+# @returns an array of n ranks, where 0 means the PIN was the first guess
+def rank_pins(scores, pins):
+    scores = np.atleast_2d(scores)
+    pins = np.atleast_1d(pins)
+    target = scores[np.arange(scores.shape[0]), pins][:, np.newaxis]
+
+    higher = np.count_nonzero(scores > target, axis=1)
+    earlier_ties = np.count_nonzero((scores == target) & (np.arange(scores.shape[1]) < pins[:, np.newaxis]), axis=1)
+    return higher + earlier_ties
+
+
+##
+# This function scores PINs given as rows of digits, one level at a time. It follows
+# the layout of the Tree, as pin_classes does: the first level pairs the first digit
+# with the key before it and every later level pairs a digit with the one before it
+#
+# @input densities - an array shaped (length, len(MODEL_SETS)) of the logprob of
+#                       each timing under each distance class
+# @input digits - an array shaped (n, length) of the digits of every PIN
+# @input previous - the index (into KEYPAD) of the key before the first digit
+# @input start - what every score starts from (1 for a whole PIN, as in score_pins)
+# @returns an array of the n scores, adding up exactly what score_pins gives whole PINs
+def digit_scores(densities, digits, previous=key_index[CODE_FOR_ENTER], start=1.0):
+    scores = np.full(digits.shape[0], float(start))
+    scores += densities[0, distance_class_table[digits[:, 0], previous]]
+    for level in range(1, digits.shape[1]):
+        scores += densities[level, distance_class_table[digits[:, level], digits[:, level - 1]]]
+    return scores
+
+
+##
+# This function scores particular PINs, adding up exactly what score_pins gives them
+#
+# @input densities - an array shaped (length, len(MODEL_SETS)) of the logprob of
+#                       each timing under each distance class
+# @input pins - an array of PIN indices
+# @returns an array of the score of every PIN
+def pin_scores(densities, pins):
+    densities = np.asarray(densities, dtype=float)
+    pins = np.asarray(pins)
+    digits = (pins[:, np.newaxis] // 10 ** np.arange(densities.shape[0] - 1, -1, -1)) % 10
+    return digit_scores(densities, digits)
+
+
+##
+# This function scores every ending of a PIN that follows a given digit, leaving out
+# the 1 every score starts from
+#
+# @input densities - an array shaped (length, len(MODEL_SETS)) of the logprob of
+#                       each timing of the ending under each distance class
+# @input boundary - the digit before the ending
+# @returns an array of the 10**length scores of every ending, indexed by the ending
+def suffix_scores(densities, boundary):
+    return digit_scores(densities, pin_digits(densities.shape[0]), boundary, 0.0)
+
+
+##
+# This function finds where a PIN falls when every PIN is ranked, as rank_pins does,
+# without scoring every PIN. The PIN is split into the digits before and after its
+# middle; the two halves only meet at the last digit of the first half, so for each
+# of the 10 digits that can be there, the scores of the second halves are sorted
+# and every first half counts how many of them push it past the target by binary
+# search. That takes O(10**(length / 2) * log) rather than O(10**length).
+#
+# A score split in two is rounded differently than one added up level by level, so
+# any pair within rounding error of the target is scored again the way score_pins
+# would, and ties are broken in ascending PIN order from there
+#
+# @input densities - an array shaped (length, len(MODEL_SETS)) of the logprob of
+#                       each timing under each distance class
+# @input pin - the PIN index to rank
+# @returns the rank of the PIN, where 0 means it was the first guess
+def split_rank(densities, pin):
+    densities = np.asarray(densities, dtype=float)
+    length = densities.shape[0]
+    if length < 2:
+        return int(rank_pins(score_pins(densities), pin)[0])
+
+    middle = length // 2
+    endings = 10 ** (length - middle)
+    target = pin_scores(densities, [pin])[0]
+
+    # the first halves are scored just as score_pins scores its first levels
+    prefixes = score_pins(densities[:middle])
+    if target == -float('inf'):
+        return impossible_rank(densities, pin, prefixes)
+
+    # every sum is within length rounding errors of the real one, each at most eps times the biggest sum
+    finite = densities[np.isfinite(densities)]
+    largest = 1 + length * (np.abs(finite).max() if finite.shape[0] > 0 else 0)
+    tolerance = 4 * length * np.finfo(float).eps * largest
+
+    rank = 0
+    for boundary in range(10):
+        suffixes = suffix_scores(densities[middle:], boundary)
+        order = np.argsort(suffixes, kind="mergesort")
+        ordered = suffixes[order]
+
+        # the first halves that end in this digit
+        lefts = np.arange(boundary, prefixes.shape[0], 10)
+        left_scores = prefixes[lefts]
+
+        with np.errstate(invalid='ignore'):
+            low = np.searchsorted(ordered, (target - tolerance) - left_scores, side="left")
+            high = np.searchsorted(ordered, (target + tolerance) - left_scores, side="right")
+        rank += int((ordered.shape[0] - high).sum())
+
+        # score every pair too close to call the same way score_pins would
+        counts = high - low
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        starts = np.cumsum(counts) - counts
+        positions = np.repeat(low, counts) + np.arange(total) - np.repeat(starts, counts)
+        pins = np.repeat(lefts, counts) * endings + order[positions]
+
+        close = pin_scores(densities, pins)
+        rank += np.count_nonzero(close > target) + np.count_nonzero((close == target) & (pins < pin))
+
+    return int(rank)
+
+
+##
+# This function ranks a PIN that no timings could have come from, for split_rank. Every
+# PIN that is possible comes first, and the rest come in ascending order, so the rank is
+# the number of possible PINs plus the number of impossible PINs before it
+#
+# @input densities - an array shaped (length, len(MODEL_SETS)) of the logprob of
+#                       each timing under each distance class
+# @input pin - the PIN index to rank
+# @input prefixes - the scores of every first half, from score_pins
+# @returns the rank of the PIN
+def impossible_rank(densities, pin, prefixes):
+    length = densities.shape[0]
+    middle = length // 2
+    endings = 10 ** (length - middle)
+    target_prefix, target_suffix = divmod(pin, endings)
+
+    # a PIN is possible when both of its halves are
+    possible, possible_before = 0, 0
+    for boundary in range(10):
+        possible_endings = np.isfinite(suffix_scores(densities[middle:], boundary))
+        lefts = np.arange(boundary, prefixes.shape[0], 10)
+        possible_lefts = np.isfinite(prefixes[lefts])
+
+        possible += np.count_nonzero(possible_lefts) * np.count_nonzero(possible_endings)
+        possible_before += np.count_nonzero(possible_lefts & (lefts < target_prefix)) * np.count_nonzero(possible_endings)
+        if target_prefix % 10 == boundary and np.isfinite(prefixes[target_prefix]):
+            possible_before += np.count_nonzero(possible_endings[:target_suffix])
+
+    return int(possible + pin - possible_before)
+
+
+##
+# This function enumerates PINs of any length from most to least likely, only
+# doing as much work as the caller consumes. Every level of a PIN scores one
+# keypair, so the PINs form a chain of 10x10 transitions; a backward pass finds
+# the best possible score of every suffix, which is then used as an exact
+# heuristic for a best-first search over PIN prefixes. Finding the first k PINs
+# takes O(k * length) heap operations, no matter how many PINs there are
+#
+# @input model - the model which predicts timings
+# @input timings - the interkey timings of an attempt (one per digit)
+# @returns a generator of [pin, probability] lists, in the order of
+#           rank_by_probability (equal scores come in ascending PIN order,
+#           up to floating-point rounding)
+def best_pins(model, timings):
+    length = len(timings)
+    if length == 0:
+        return
+
+    densities = np.array([[model.probability(set_name, timing) for set_name in MODEL_SETS]
+                          for timing in timings])
+
+    # transitions[level][parent, digit] is the logprob of going from parent to digit at that level;
+    # as in Distance, each level looks up the keypair (digit, parent digit)
+    first_level = densities[0, distance_class_table[:10, key_index[CODE_FOR_ENTER]]]
+    transitions = [None] + [densities[level, distance_class_table[:10, :10].T] for level in range(1, length)]
+
+    # best_suffix[level][digit] is the best score that can follow digit being at level - 1
+    best_suffix = [None] * (length + 1)
+    best_suffix[length] = np.zeros(10)
+    for level in range(length - 1, 0, -1):
+        best_suffix[level] = np.max(transitions[level] + best_suffix[level + 1], axis=1)
+
+    # the heap holds (-best reachable score, prefix, score of the prefix)
+    heap = [(-(1 + first_level[digit] + best_suffix[1][digit]), str(digit), 1 + first_level[digit])
+            for digit in range(10)]
+    heapq.heapify(heap)
+
+    while heap:
+        priority, prefix, score = heapq.heappop(heap)
+        level = len(prefix)
+
+        if level == length:
+            yield [prefix, score]
+            continue
+
+        parent = int(prefix[-1])
+        for digit in range(10):
+            child_score = score + transitions[level][parent, digit]
+            heapq.heappush(heap, (-(child_score + best_suffix[level + 1][digit]), prefix + str(digit), child_score))
+
+
+class Scorer:
+    def __init__(self, model, *timings):
+        self.model = model
+        self.timings = list(timings)
+        self.length = len(self.timings)
+        self.scores = self.score()
+
+    ##
+    # This function evaluates every timing against every distance class and
+    # gathers the results into a score for every PIN
+    #
+    # @returns an array of 10**length logprobs, indexed by PIN
+    def score(self):
+        densities = [[self.model.probability(set_name, timing) for set_name in MODEL_SETS]
+                     for timing in self.timings]
+        return score_pins(densities)
+
+    ##
+    # @returns the score of every PIN, indexed by PIN
+    ##
+    def get_scores(self):
+        return self.scores
+
+    ##
+    # This function ranks all possible PINs in the order of highest
+    # to lowest probability, in the same format as Tree.rank_by_probability
+    ##
+    def rank_by_probability(self):
+        # a stable sort keeps equally likely PINs in ascending order, as the Tree does
+        order = np.argsort(-self.scores, kind="mergesort")
+        return [[pin_string(i, self.length), self.scores[i]] for i in order]
+
+    ##
+    # This function finds how many guesses it takes to reach a PIN when guessing
+    # from highest to lowest probability, without sorting every PIN. PINs that
+    # score the same as the target are guessed in ascending order, so this is
+    # the position of the PIN in rank_by_probability
+    #
+    # @input pin - the PIN to find, as a string (e.g. "0012") or an int
+    # @returns the number of PINs guessed before it
+    ##
+    def rank_of(self, pin):
+        return int(rank_pins(self.scores, int(pin))[0])
+
+    ##
+    # This function finds the k most likely PINs without sorting every PIN, for
+    # guess budgets far smaller than the number of PINs (e.g. 3 tries at an ATM)
+    #
+    # @input k - the number of PINs to return
+    # @returns the first k entries of rank_by_probability
+    ##
+    def top_k(self, k):
+        # top_pins breaks ties the same way as rank_of
+        return [[pin_string(i, self.length), self.scores[i]] for i in top_pins(self.scores, k)]
+
+    ##
+    # This function extracts all possible PINs and their probabilities
+    ##
+    def extract(self):
+        return [[pin_string(i, self.length), score] for i, score in enumerate(self.scores)]
+
+# End of file
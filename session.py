@@ -0,0 +1,71 @@
+##
+# Session class that follows one PIN entry as it is typed, scoring every
+# PIN prefix a keystroke at a time instead of building a Tree at the end
+##
+from common import CODE_FOR_BACKSPACE, CODE_FOR_ENTER, key_index, interkey_ms
+from scorer import extend_scores, top_pins, pin_string
+
+
+class Session:
+    ##
+    # Constructor for a session with nothing typed yet
+    #
+    # @input model - the model which predicts timings
+    # @input length - the most digits a PIN can have
+    def __init__(self, model, length=4):
+        self.model = model
+        self.length = length
+        self.reset()
+
+    ##
+    # This function forgets everything typed so far
+    def reset(self):
+        self.last_time = None
+        self.scores = None
+        self.digits = 0
+        self.complete = False
+
+    ##
+    # This function takes in one keystroke and updates the score of every PIN prefix.
+    # Every timing belongs to the digit typed before it, so a prefix of n digits
+    # is scored once the key after its last digit comes in
+    #
+    # @input key - the key pressed (a digit, CODE_FOR_ENTER or CODE_FOR_BACKSPACE)
+    # @input time - the time of the keystroke, in microseconds since the epoch
+    # @returns whether the keystroke finished the PIN entry (a ValueError is raised
+    #           for keys that aren't on the keypad, which leave the session as it was)
+    def press(self, key, time):
+        if key not in key_index and key != CODE_FOR_BACKSPACE:
+            raise ValueError("not a key on the keypad: " + str(key))
+
+        # a keystroke after a finished entry starts the next one
+        if self.complete:
+            self.reset()
+
+        # clean_data throws out entries with corrections, so start over on a backspace
+        if key == CODE_FOR_BACKSPACE:
+            self.reset()
+            return False
+
+        if self.last_time is not None:
+            # a PIN longer than the model scores starts over from this keystroke
+            if self.digits == self.length:
+                self.reset()
+            else:
+                densities = self.model.log_densities([interkey_ms(self.last_time, time)])[0]
+                self.scores = extend_scores(self.scores, densities)
+                self.digits += 1
+
+        self.last_time = time
+        self.complete = key == CODE_FOR_ENTER
+        return self.complete
+
+    ##
+    # @input k - the number of candidates to return
+    # @returns a list of the k most likely PIN prefixes typed so far, as [prefix, probability] lists
+    def top(self, k):
+        if self.scores is None:
+            return []
+        return [[pin_string(i, self.digits), self.scores[i]] for i in top_pins(self.scores, k)]
+
+# End of file
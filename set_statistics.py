@@ -0,0 +1,128 @@
+##
+# SetStatistics class that gathers the timings of one set of keypairs once, and
+# works out each statistic of them the first time it is asked for
+##
+from model import fit_gamma
+from scipy import stats
+import numpy as np
+
+# the histogram bin edges always fall on multiples of 25, from 50 to 625
+BIN_EDGES = np.arange(50, 650, 25)
+
+##
+# This function runs Welch's t-test (as stats.ttest_ind with equal_var=False does) between
+# every two of k groups at once, from just the size, mean and sample variance of every group
+#
+# @input ns - an array of the number of timings in every group
+# @input means - an array of the mean of every group
+# @input variances - an array of the sample variance (ddof=1) of every group
+# @returns a pair of k x k arrays of the t statistic and the p value of every two groups,
+#           where entry [i, j] tests group i against group j (NaN where a group is empty)
+def welch_t_tests(ns, means, variances):
+    ns = np.asarray(ns)
+    means = np.asarray(means, dtype=float)
+    variances = np.asarray(variances, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vn = variances / ns
+        vn1, vn2 = vn[:, np.newaxis], vn[np.newaxis, :]
+        n1, n2 = ns[:, np.newaxis], ns[np.newaxis, :]
+        df = (vn1 + vn2)**2 / (vn1**2 / (n1 - 1) + vn2**2 / (n2 - 1))
+
+        # if df is undefined the variances are zero, so any df that isn't NaN will do
+        df = np.where(np.isnan(df), 1, df)
+        t = np.divide(means[:, np.newaxis] - means[np.newaxis, :], np.sqrt(vn1 + vn2))
+        p = stats.t.sf(np.abs(t), df) * 2
+
+    # there is no test with an empty group
+    empty = (n1 == 0) | (n2 == 0)
+    t[empty] = np.nan
+    p[empty] = np.nan
+
+    return t, p
+
+##
+# @input statistics - a list of SetStatistics
+# @returns a pair of k x k arrays of the t statistic and p value of Welch's t-test
+#           between every two sets (see welch_t_tests)
+def t_test_matrix(statistics):
+    return welch_t_tests([s.get_n() for s in statistics],
+                         [s.get_mean() if s.get_n() > 0 else np.nan for s in statistics],
+                         [s.get_variance(1) if s.get_n() > 1 else np.nan for s in statistics])
+
+
+class SetStatistics:
+    ##
+    # Constructor for the statistics of a set; nothing is computed until it is needed
+    #
+    # @input timings - a dictionary of lists of ints, where the dictionary
+    #                   connects a keypair (e.g. "12") to every interkey
+    #                   timing used to enter it (or a TimingStore)
+    # @input given_set - the keypairs of the set (e.g. all_sets["dist_one"])
+    # @input array - every timing of the set, if already gathered (e.g. by common.class_timings)
+    def __init__(self, timings, given_set, array=None):
+        self.timings = timings
+        self.given_set = given_set
+        self.__array = None if array is None else np.asarray(array, dtype=np.int64)
+        self.__mean = None
+        self.__variances = {}
+        self.__histogram = None
+        self.__gamma = None
+
+    ##
+    # @returns an array of every timing of the set, in the order of the keypairs in the set
+    def get_array(self):
+        if self.__array is None:
+            # don't use timings[x], since that would add empty keypairs to a defaultdict
+            self.__array = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                          [np.asarray(self.timings.get(keypair, []), dtype=np.int64) for keypair in self.given_set])
+        return self.__array
+
+    ##
+    # @returns the number of timings in the set
+    def get_n(self):
+        return self.get_array().shape[0]
+
+    ##
+    # @returns the mean of the timings
+    def get_mean(self):
+        if self.__mean is None:
+            self.__mean = np.mean(self.get_array())
+        return self.__mean
+
+    ##
+    # @input ddof - the delta degrees of freedom (0 for the population variance, 1 for the sample variance)
+    # @returns the variance of the timings
+    def get_variance(self, ddof=0):
+        if ddof not in self.__variances:
+            self.__variances[ddof] = np.var(self.get_array(), ddof=ddof)
+        return self.__variances[ddof]
+
+    ##
+    # @returns the (population) standard deviation of the timings
+    def get_std(self):
+        return np.sqrt(self.get_variance())
+
+    ##
+    # @returns an array of how many timings fall in every bin of BIN_EDGES
+    def get_histogram(self):
+        if self.__histogram is None:
+            self.__histogram = np.histogram(self.get_array(), bins=BIN_EDGES)[0]
+        return self.__histogram
+
+    ##
+    # @returns an array of the density of the timings in every bin of BIN_EDGES,
+    #           normalized over the timings within the bins
+    def get_density(self):
+        counts = self.get_histogram()
+        # the same sum np.histogram's normed=True divides by
+        return counts / (counts * np.array(np.diff(BIN_EDGES), float)).sum()
+
+    ##
+    # @returns the (alpha, loc, beta) of a gamma distribution fit to the timings, the same fit the Model makes
+    def get_gamma(self):
+        if self.__gamma is None:
+            self.__gamma = fit_gamma(self.get_array())
+        return self.__gamma
+
+# End of file
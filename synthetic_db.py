@@ -0,0 +1,164 @@
+##
+# Generator of synthetic keystroke databases, laid out like the attempts table
+# the simulated ATM collects into, for testing and benchmarking without real data
+##
+from common import *
+import numpy as np
+import argparse
+import json
+
+# the gamma (alpha, loc, beta) that timings of every distance class are drawn from, in ms;
+# keys further apart take longer to get between
+DEFAULT_PARAMETERS = dict(
+    [(set_name, (4.0, 80.0 + 20.0 * class_id, 30.0 + 5.0 * class_id)) for class_id, set_name in enumerate(distance_classes[:8])] +
+    [(set_name, (4.0, 150.0, 40.0)) for set_name in distance_classes[8:]]
+)
+
+# the gamma that timings of keypairs outside every distance class (e.g. with a backspace) are drawn from
+OTHER_PARAMETERS = (4.0, 200.0, 50.0)
+
+# when the first synthetic attempt starts
+START_TIME = np.datetime64('2017-07-01T10:00:00', 'us')
+
+##
+# This function picks one PIN per distance class that uses it, so that any
+# database built from them has timings for every class a Model fits
+#
+# @returns a list of PINs
+def covering_pins():
+    pins = []
+    for set_name in distance_classes:
+        keypair = all_sets[set_name][0]
+        if keypair[1] == CODE_FOR_ENTER:
+            pins.append(int(keypair[0] * 4))
+        else:
+            pins.append(int(keypair * 2))
+    return pins
+
+##
+# This function makes up the keys of one attempt at entering a PIN
+#
+# @input pin - the PIN meant to be entered
+# @input rng - a numpy RandomState
+# @input backspace_rate - the chance that a wrong digit is typed and then backspaced over
+# @input error_rate - the chance that a digit is typed wrong and never fixed
+# @returns a list of the keys pressed, ending in CODE_FOR_ENTER
+def attempt_keys(pin, rng, backspace_rate, error_rate):
+    keys = list(("0000" + str(pin))[-4:])
+
+    if rng.random_sample() < error_rate:
+        position = rng.randint(len(keys))
+        keys[position] = str((int(keys[position]) + rng.randint(1, 10)) % 10)
+
+    if rng.random_sample() < backspace_rate:
+        position = rng.randint(len(keys))
+        keys[position:position] = [str(rng.randint(10)), CODE_FOR_BACKSPACE]
+
+    return keys + [CODE_FOR_ENTER]
+
+##
+# This function draws the time between two keys
+#
+# @input key_a - the key pressed first
+# @input key_b - the key pressed second
+# @input rng - a numpy RandomState
+# @input parameters - a dictionary connecting distance classes to the gamma (alpha, loc, beta) of their timings
+# @returns the time between the keys, in microseconds
+def draw_timing(key_a, key_b, rng, parameters):
+    alpha, loc, beta = OTHER_PARAMETERS
+    if key_a in key_index and key_b in key_index and distance_class(key_a, key_b) >= 0:
+        alpha, loc, beta = parameters[distance_class_name(distance_class(key_a, key_b))]
+    return int((loc + rng.gamma(alpha, beta)) * (10**3))
+
+##
+# This function generates keystrokes as the simulated ATM would collect them
+#
+# @input users - the number of users
+# @input pins - the number of PINs every user enters (at least one per distance class)
+# @input attempts - the number of times every user enters every PIN
+# @input backspace_rate - the chance that an attempt has a backspace in it
+# @input error_rate - the chance that an attempt enters the wrong PIN
+# @input parameters - a dictionary connecting distance classes to the gamma (alpha, loc, beta) of their timings
+#                       (any class left out keeps its DEFAULT_PARAMETERS)
+# @input seed - the seed of the random numbers, so that the same arguments give the same rows
+# @returns a list of 4-tuples of (user, PIN, key pressed, time), in the order they were typed
+def generate_rows(users=12, pins=40, attempts=4, backspace_rate=0.05, error_rate=0.05, parameters=None, seed=0):
+    rng = np.random.RandomState(seed)
+    all_parameters = dict(DEFAULT_PARAMETERS)
+    all_parameters.update(parameters or {})
+
+    pin_list = covering_pins()
+    pin_list += [int(pin) for pin in rng.randint(0, 10**4, max(pins - len(pin_list), 0))]
+
+    user_list, pin_column, key_column, offsets = [], [], [], []
+    for user_id in range(users):
+        user = "u%04d" % user_id
+        now = rng.randint(0, 4 * 86400) * (10**6)
+
+        for pin in pin_list:
+            for attempt in range(attempts):
+                keys = attempt_keys(pin, rng, backspace_rate, error_rate)
+                for key_a, key_b in zip([None] + keys[:-1], keys):
+                    if key_a is not None:
+                        now += draw_timing(key_a, key_b, rng, all_parameters)
+                    user_list.append(user)
+                    pin_column.append(pin)
+                    key_column.append(key_b)
+                    offsets.append(now)
+
+                # leave a couple of seconds between attempts
+                now += 2 * (10**6)
+
+    # format every time at once, the way the database stores them
+    times = np.datetime_as_string(START_TIME + np.array(offsets, dtype='timedelta64[us]'))
+    times = [time.replace("T", " ") for time in times.tolist()]
+
+    return list(zip(user_list, pin_column, key_column, times))
+
+##
+# This function writes keystrokes into a new attempts table
+#
+# @input database - the path of the SQLite database to create
+# @input rows - a list of 4-tuples of (user, PIN, key pressed, time)
+def write_database(database, rows):
+    if os.path.exists(database):
+        os.remove(database)
+
+    conn = sqlite3.connect(database)
+    conn.execute('CREATE TABLE attempts (userString TEXT, pinAttempted INTEGER, keyPressed TEXT, time TEXT)')
+    conn.executemany('INSERT INTO attempts VALUES (?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+##
+# This function generates a synthetic database
+#
+# @input database - the path of the SQLite database to create (any old one is replaced)
+# @input kwargs - the arguments of generate_rows
+# @returns the number of keystrokes written
+def generate_database(database=DATABASE, **kwargs):
+    rows = generate_rows(**kwargs)
+    write_database(database, rows)
+    return len(rows)
+
+# python synthetic_db.py [--database DB] [--users N] [--pins N] [--attempts N] [--backspace_rate P] [--error_rate P] [--parameters JSON] [--seed N]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Specify arguments')
+    parser.add_argument('--database', help='database to create', default=DATABASE)
+    parser.add_argument('--users', help='number of users', type=int, default=12)
+    parser.add_argument('--pins', help='number of PINs every user enters', type=int, default=40)
+    parser.add_argument('--attempts', help='number of times every user enters every PIN', type=int, default=4)
+    parser.add_argument('--backspace_rate', help='chance that an attempt has a backspace in it', type=float, default=0.05)
+    parser.add_argument('--error_rate', help='chance that an attempt enters the wrong PIN', type=float, default=0.05)
+    parser.add_argument('--parameters', help='JSON file connecting distance classes to the gamma [alpha, loc, beta] of their timings', default=None)
+    parser.add_argument('--seed', help='seed of the random numbers', type=int, default=0)
+    args = parser.parse_args()
+
+    parameters = None
+    if args.parameters is not None:
+        with open(args.parameters) as f:
+            parameters = dict((set_name, tuple(value)) for set_name, value in json.load(f).items())
+
+    print generate_database(args.database, users=args.users, pins=args.pins, attempts=args.attempts,
+                            backspace_rate=args.backspace_rate, error_rate=args.error_rate,
+                            parameters=parameters, seed=args.seed), "keystrokes written to", args.database
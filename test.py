@@ -1,7 +0,0 @@
-from tree import Tree
-
-
-tree = Tree()
-#tree.rank()
-n = tree.num_leaves()
-print(n)
@@ -0,0 +1,607 @@
+##
+# Tests that the fast paths give the same answers as the code they replace,
+# on a small synthetic database
+#
+# python -m unittest tests
+##
+from common import *
+from attempt_cache import CleanedAttempts, COLUMNS, load_attempts, load_cache, save_cache, cache_path, cache_stamp
+from candidates import CandidateList, write_candidates
+from fold_timings import FoldTimings
+from model import Model, fit_gamma, class_fits, set_fit_cache, histogram_density, kde_density, HISTOGRAM_BIN_MS, KDE_BANDWIDTH_MS
+from scorer import Scorer, score_pins, rank_pins, top_pins, split_rank, best_pins, extend_scores, digit_scores, pin_scores, suffix_scores, pin_digits
+from session import Session
+from set_statistics import SetStatistics, welch_t_tests, t_test_matrix
+from synthetic_db import generate_database
+from timing_store import TimingStore, BIGRAM_CLASSES, group_percentiles
+from tree import Tree
+import inference
+import profiling
+import timing_stats
+from scipy import stats
+from scipy.stats import gamma
+from scipy.special import logsumexp
+from dateutil import parser as prsr
+from dateutil import tz
+import numpy as np
+import itertools
+import argparse
+import unittest
+import warnings
+import tempfile
+import shutil
+
+# the directory of the synthetic database, and the model fit to it, shared by every test
+directory = None
+database = None
+model = None
+
+# interkey timings (in ms) of attempts to rank, including ones off the model's table and a tie-heavy one
+TIMINGS = [(250, 180, 320, 210), (95, 610, 140.5, 400), (0, 0, 0, 0), (1200, 90000, 300, 250)]
+
+
+def setUpModule():
+    global directory, database, model
+    directory = tempfile.mkdtemp()
+    database = os.path.join(directory, "attempts.db")
+    set_fit_cache(os.path.join(directory, "fits"))
+    generate_database(database, users=4, pins=30, attempts=3, seed=1)
+    model = Model(filter_timings(parse_data(clean_data(preprocess_data(retrieve_data(database, []), presorted=True)))))
+
+def tearDownModule():
+    shutil.rmtree(directory)
+
+##
+# @returns a new directory to run a script in, holding a copy of the synthetic database and the directories it writes to
+def run_directory():
+    path = tempfile.mkdtemp(dir=directory)
+    shutil.copy(database, os.path.join(path, DATABASE))
+    os.makedirs(os.path.join(path, 'outputs', 'plots'))
+    return path
+
+
+class ScorerTest(unittest.TestCase):
+    def test_matches_tree(self):
+        for timings in TIMINGS:
+            expected = Tree(model, *timings).rank_by_probability()
+            actual = Scorer(model, *timings).rank_by_probability()
+
+            self.assertEqual([pin for pin, score in actual], [pin for pin, score in expected])
+            np.testing.assert_allclose([score for pin, score in actual], [score for pin, score in expected])
+
+    def test_rank_of_and_top_k_match_ranking(self):
+        scorer = Scorer(model, *TIMINGS[1])
+        ranking = scorer.rank_by_probability()
+
+        self.assertEqual(scorer.top_k(25), ranking[:25])
+        for position in [0, 1, 17, 5000, 9999]:
+            self.assertEqual(scorer.rank_of(ranking[position][0]), position)
+
+
+class ModelTest(unittest.TestCase):
+    def test_table_matches_logpdf(self):
+        timings = filter_timings(parse_data(clean_data(preprocess_data(retrieve_data(database, []), presorted=True))))
+        # timings within the table, and ones between, before and past it
+        grid = np.concatenate((np.arange(0, 2000, 13), [0.5, 140.5, -3, 90000, 10 ** 6]))
+
+        for class_id, set_name in enumerate(distance_classes):
+            with np.errstate(divide='ignore'):
+                expected = np.log(gamma(*fit_gamma(set_timings(timings, all_sets[set_name]))).pdf(grid))
+
+            np.testing.assert_allclose(model.probabilities(set_name, grid), expected)
+            np.testing.assert_allclose(model.log_densities(grid)[:, class_id], expected)
+            np.testing.assert_allclose([model.probability(set_name, timing) for timing in grid], expected)
+
+        self.assertEqual(model.probability("dist_one_left", 250), -float('inf'))
+
+    def test_fit_cache(self):
+        data = np.random.RandomState(1).gamma(4.0, 30.0, 500) + 80
+        fit = fit_gamma(data)
+
+        # the same timings in any order are the same fit, from memory and then from disk
+        self.assertEqual(fit_gamma(data[::-1]), fit)
+        set_fit_cache(os.path.join(directory, "fits"))
+        self.assertEqual(fit_gamma(np.random.RandomState(2).permutation(data)), fit)
+        np.testing.assert_allclose(fit, gamma.fit(np.sort(data)))
+
+    def test_warm_start(self):
+        timings = filter_timings(parse_data(clean_data(preprocess_data(retrieve_data(database, []), presorted=True))))
+        warm = Model(timings, initial_parameters=class_fits(timings))
+
+        self.assertRaises(ValueError, Model, timings, "kde", class_fits(timings))
+        for set_name in distance_classes:
+            np.testing.assert_allclose(warm.probabilities(set_name, [150, 300]), model.probabilities(set_name, [150, 300]), rtol=1e-2)
+
+
+class DensityBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (np.random.RandomState(0).gamma(4.0, 30.0, 2000) + 80).astype(int)
+
+    def test_histogram(self):
+        log_density = histogram_density(self.data)
+        grid = np.arange(0, 200000)
+
+        # every ms gets the density of its bin, so the sum over every ms is the integral
+        densities = log_density(grid)
+        self.assertTrue(np.isfinite(densities).all())
+        self.assertAlmostEqual(np.exp(densities).sum(), 1.0, places=3)
+        # up to the tail, the density is the same all through a bin
+        starts = np.arange(0, self.data.max() + 1, HISTOGRAM_BIN_MS)
+        np.testing.assert_array_equal(log_density(starts + HISTOGRAM_BIN_MS - 0.5), densities[starts])
+        self.assertEqual(log_density([-1])[0], -float('inf'))
+
+    def test_kde_matches_exact_sum(self):
+        log_density = kde_density(self.data)
+        grid = np.concatenate((np.arange(0, 3000, 7), [140.5, 10 ** 5]))
+
+        expected = logsumexp(stats.norm.logpdf(grid[:, np.newaxis], self.data[np.newaxis, :], KDE_BANDWIDTH_MS), axis=1)
+        np.testing.assert_allclose(log_density(grid), expected - np.log(self.data.shape[0]), rtol=1e-9)
+
+    def test_model_backends(self):
+        timings = filter_timings(parse_data(clean_data(preprocess_data(retrieve_data(database, []), presorted=True))))
+        grid = np.arange(0, 1500, 11)
+
+        for backend, density in [("histogram", histogram_density), ("kde", kde_density)]:
+            backend_model = Model(timings, backend)
+            for set_name in ["dist_one", "nine_to_enter"]:
+                np.testing.assert_allclose(backend_model.probabilities(set_name, grid),
+                                           density(set_timings(timings, all_sets[set_name]))(grid))
+        self.assertRaises(ValueError, Model, timings, "normal")
+
+
+class BestPinsTest(unittest.TestCase):
+    def test_matches_rank_by_probability(self):
+        for timings in TIMINGS:
+            expected = Scorer(model, *timings).rank_by_probability()
+            scores = dict((pin, score) for pin, score in expected)
+            actual = list(itertools.islice(best_pins(model, timings), 50))
+
+            # equal scores may come out in another order, but every PIN is scored the same and none is skipped
+            np.testing.assert_allclose([score for pin, score in actual], [score for pin, score in expected[:50]])
+            np.testing.assert_allclose([score for pin, score in actual], [scores[pin] for pin, score in actual])
+            self.assertEqual(len(set(pin for pin, score in actual)), 50)
+
+    def test_enumerates_every_pin(self):
+        actual = list(best_pins(model, TIMINGS[0][:2]))
+        self.assertEqual(sorted(pin for pin, score in actual), ["%02d" % pin for pin in range(100)])
+
+
+class SessionTest(unittest.TestCase):
+    def test_extend_scores_matches_score_pins(self):
+        for timings in TIMINGS:
+            densities = model.log_densities(timings)
+            scores = None
+            for level in range(len(timings)):
+                scores = extend_scores(scores, densities[level])
+                np.testing.assert_array_equal(scores, score_pins(densities[:level + 1]))
+
+    def test_press_matches_score_pins(self):
+        session = Session(model)
+        # a stray keystroke and a corrected entry come first, and are both thrown away
+        keys = ["7", "e", "1", "b", "1", "2", "3", "4", "e"]
+        times = np.cumsum([0, 10 ** 7, 10 ** 7, 200000, 300000, 250000, 180000, 320000, 210000]).tolist()
+
+        for key, time in zip(keys, times):
+            complete = session.press(key, time)
+
+        self.assertTrue(complete)
+        self.assertEqual(session.digits, 4)
+        scores = score_pins(model.log_densities(TIMINGS[0]))
+        np.testing.assert_array_equal(session.scores, scores)
+        self.assertEqual([pin for pin, score in session.top(5)], ["%04d" % pin for pin in top_pins(scores, 5)])
+        self.assertRaises(ValueError, session.press, "x", times[-1])
+
+
+class DistanceClassTest(unittest.TestCase):
+    def test_class_timings_match_set_timings(self):
+        timings = parse_data(clean_data(preprocess_data(retrieve_data(database, []), presorted=True)))
+        for class_id, grouped in enumerate(class_timings(timings)):
+            expected = set_timings(timings, all_sets[distance_classes[class_id]])
+            self.assertEqual(sorted(grouped.tolist()), sorted(expected))
+
+
+class TimestampTest(unittest.TestCase):
+    # what dateutil makes of a timestamp, in microseconds since the epoch (in UTC where it has an offset)
+    def dateutil_us(self, text):
+        parsed = prsr.parse(text)
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(tz.tzutc()).replace(tzinfo=None)
+        delta = parsed - EPOCH
+        return (delta.days * 86400 + delta.seconds) * (10**6) + delta.microseconds
+
+    def test_iso_fast_path(self):
+        texts = ["2017-07-12 14:23:45.123456", "2017-07-12T14:23:45", "1969-12-31 23:59:59.5", "2017-07-12 14:23"]
+        expected = [self.dateutil_us(text) for text in texts]
+
+        self.assertEqual(parse_timestamps(texts).tolist(), expected)
+        self.assertEqual([parse_timestamp(text) for text in texts], expected)
+
+    def test_fallback_matches_dateutil(self):
+        # none of these are ISO 8601, so NumPy refuses them and dateutil reads them
+        texts = ["12 Jul 2017 14:23:45.123456", "07/12/2017 2:23:45 PM", "Wed, 12 Jul 2017 16:23:45 +0200", "July 12, 2017 14:23:45.000001"]
+        for text in texts:
+            self.assertRaises(ValueError, np.datetime64, text, 'us')
+            self.assertEqual(parse_timestamp(text), self.dateutil_us(text))
+        self.assertEqual(parse_timestamps(texts).tolist(), [self.dateutil_us(text) for text in texts])
+
+    def test_offset(self):
+        # a timestamp with an offset is the same moment in UTC, by whichever path reads it
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for text in ["2017-07-12 16:23:45.5+02:00", "2017-07-12T16:23:45.5+02:00", "12 Jul 2017 16:23:45.5 +02:00"]:
+                self.assertEqual(parse_timestamp(text), parse_timestamp("2017-07-12 14:23:45.5"))
+                self.assertEqual(parse_timestamp(text), self.dateutil_us(text))
+
+    def test_mixed_column(self):
+        # one malformed row sends the whole column down the fallback, which must still read the ISO rows
+        texts = ["2017-07-12 14:23:45.123456", "12 Jul 2017 14:23:46 +0200", "2017-07-12 14:23:47", "07/12/2017 2:23:48 PM"]
+        self.assertRaises(ValueError, np.array, texts, dtype='datetime64[us]')
+
+        self.assertEqual(parse_timestamps(texts).tolist(), [self.dateutil_us(text) for text in texts])
+        self.assertEqual(parse_timestamps(texts).dtype, np.int64)
+
+
+class AttemptCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.database = os.path.join(directory, "cached.db")
+        shutil.copy(database, self.database)
+        self.path = cache_path(self.database)
+
+    def tearDown(self):
+        os.remove(self.database)
+        shutil.rmtree(self.path, True)
+
+    def test_matches_stream_clean_data(self):
+        rejected = {}
+        expected = CleanedAttempts.from_attempts(stream_clean_data(retrieve_data_chunks(self.database, []), rejected))
+        load_attempts(self.database, [])
+        cached = load_cache(self.path, cache_stamp(self.database, []))
+
+        self.assertIsNotNone(cached)
+        for column in COLUMNS:
+            np.testing.assert_array_equal(getattr(cached, column), getattr(expected, column))
+
+        # the counts of the cleaning are kept for runs that hit the cache
+        self.assertEqual(cached.counts["rows_read"], len(retrieve_data(self.database, [])))
+        self.assertEqual(cached.counts["attempts_kept"], len(expected))
+        for reason in rejected:
+            self.assertEqual(cached.counts["attempts_rejected_" + reason], rejected[reason])
+
+    def test_stale_when_database_changes(self):
+        load_attempts(self.database, [])
+        before = os.stat(self.database)
+
+        # the same size, but modified later
+        os.utime(self.database, (before.st_atime, before.st_mtime + 1))
+        self.assertIsNone(load_cache(self.path, cache_stamp(self.database, [])))
+        load_attempts(self.database, [])
+        self.assertIsNotNone(load_cache(self.path, cache_stamp(self.database, [])))
+
+        # more rows, but with the modification time put back
+        conn = sqlite3.connect(self.database)
+        conn.executemany('INSERT INTO attempts VALUES (?, ?, ?, ?)', [("u9999", 1234, "1", "2017-07-01 10:00:00")] * 1000)
+        conn.commit()
+        conn.close()
+        os.utime(self.database, (before.st_atime, before.st_mtime + 1))
+        self.assertIsNone(load_cache(self.path, cache_stamp(self.database, [])))
+
+    def test_stale_when_excluded_users_change(self):
+        excluded = [str(load_attempts(self.database, []).user_names[0])]
+        self.assertIsNone(load_cache(self.path, cache_stamp(self.database, excluded)))
+
+        attempts = load_attempts(self.database, excluded)
+        self.assertNotIn(excluded[0], [str(user) for user in attempts.user_names])
+        self.assertIsNotNone(load_cache(self.path, cache_stamp(self.database, excluded)))
+
+    def test_save_over_current_cache(self):
+        attempts = load_attempts(self.database, [])
+        self.assertFalse(save_cache(attempts, self.path, cache_stamp(self.database, [])))
+        self.assertTrue(save_cache(attempts, self.path, cache_stamp(self.database, ["u0000"])))
+
+        # nothing is left behind next to the cache
+        self.assertEqual([name for name in os.listdir(directory) if name.startswith(os.path.basename(self.path))],
+                         [os.path.basename(self.path)])
+
+
+class TimingStoreTest(unittest.TestCase):
+    def test_matches_parse_data(self):
+        keystrokes = clean_data(preprocess_data(retrieve_data(database, []), presorted=True))
+        store = TimingStore.from_attempts(CleanedAttempts.from_attempts(stream_clean_data(retrieve_data_chunks(database, []))))
+
+        expected = parse_data(keystrokes)
+        self.assertEqual(sorted(store.keys()), sorted(expected.keys()))
+        for keypair in expected:
+            self.assertEqual(sorted(store[keypair].tolist()), sorted(expected[keypair]))
+        for set_name in ["dist_one", "dist_one_left", "nine_to_enter"]:
+            self.assertEqual(sorted(store.set_timings(set_name).tolist()), sorted(set_timings(expected, all_sets[set_name])))
+
+        for user in keystrokes:
+            expected = parse_data({user: keystrokes[user]})
+            self.assertEqual(dict((keypair, sorted(timing.tolist())) for keypair, timing in store.user(str(user)).items()),
+                             dict((keypair, sorted(timing)) for keypair, timing in expected.items()))
+
+
+class OutlierTest(unittest.TestCase):
+    def setUp(self):
+        self.store = TimingStore.from_attempts(CleanedAttempts.from_attempts(stream_clean_data(retrieve_data_chunks(database, []))))
+
+    def test_group_percentiles_match_np_percentile(self):
+        rng = np.random.RandomState(0)
+        values = rng.randint(0, 50, 500)
+        groups = rng.randint(0, 7, 500)
+        groups[groups == 3] = 4
+
+        for percentile in [0, 37.5, 95, 100]:
+            actual = group_percentiles(values, groups, 8, percentile)
+            for group in range(8):
+                if (groups == group).any():
+                    self.assertAlmostEqual(actual[group], np.percentile(values[groups == group], percentile))
+                else:
+                    self.assertTrue(np.isnan(actual[group]))
+
+    def test_outlier_mask_matches_np_percentile(self):
+        timings = self.store.timings
+        np.testing.assert_array_equal(self.store.outlier_mask(95, "global"), timings < np.percentile(timings, 95))
+
+        for scope, groups in [("user", self.store.users), ("class", BIGRAM_CLASSES[self.store.bigrams])]:
+            expected = np.zeros(timings.shape[0], dtype=bool)
+            for group in np.unique(groups):
+                expected[groups == group] = timings[groups == group] < np.percentile(timings[groups == group], 95)
+            np.testing.assert_array_equal(self.store.outlier_mask(95, scope), expected)
+
+        self.assertRaises(ValueError, self.store.outlier_mask, 95, "keypair")
+
+    def test_filter_timings_matches_dictionary(self):
+        expected = filter_timings(parse_data(clean_data(preprocess_data(retrieve_data(database, []), presorted=True))))
+        actual = filter_timings(self.store)
+
+        self.assertEqual(dict((keypair, sorted(timing.tolist())) for keypair, timing in actual.items()),
+                         dict((keypair, sorted(timing)) for keypair, timing in expected.items() if timing))
+
+
+class WelchTest(unittest.TestCase):
+    def test_matches_ttest_ind(self):
+        rng = np.random.RandomState(0)
+        groups = [rng.gamma(4.0, 30.0, n) + loc for n, loc in [(40, 100), (7, 120), (300, 100), (2, 90)]]
+
+        t, p = welch_t_tests([group.shape[0] for group in groups], [np.mean(group) for group in groups],
+                             [np.var(group, ddof=1) for group in groups])
+        for i, j in itertools.permutations(range(len(groups)), 2):
+            expected_t, expected_p = stats.ttest_ind(groups[i], groups[j], equal_var=False)
+            self.assertAlmostEqual(t[i, j], expected_t)
+            self.assertAlmostEqual(p[i, j], expected_p)
+
+    def test_t_test_matrix_of_sets(self):
+        timings = parse_data(clean_data(preprocess_data(retrieve_data(database, []), presorted=True)))
+        names = ["dist_one", "dist_two", "dist_one_left", "dist_three_up"]
+        t, p = t_test_matrix([SetStatistics(timings, all_sets[name]) for name in names])
+
+        for i, j in itertools.combinations(range(len(names)), 2):
+            expected_t, expected_p = stats.ttest_ind(set_timings(timings, all_sets[names[i]]),
+                                                     set_timings(timings, all_sets[names[j]]), equal_var=False)
+            self.assertAlmostEqual(t[i, j], expected_t)
+            self.assertAlmostEqual(p[i, j], expected_p)
+
+    def test_gamma_matches_model(self):
+        timings = parse_data(clean_data(preprocess_data(retrieve_data(database, []), presorted=True)))
+        for name in ["dist_one", "dist_three_up"]:
+            self.assertEqual(SetStatistics(timings, all_sets[name]).get_gamma(), fit_gamma(set_timings(timings, all_sets[name])))
+
+
+class FoldTimingsTest(unittest.TestCase):
+    def test_matches_filter_timings_per_fold(self):
+        keystrokes = clean_data(preprocess_data(retrieve_data(database, []), presorted=True))
+        attempts = CleanedAttempts.from_attempts(stream_clean_data(retrieve_data_chunks(database, [])))
+
+        for folds in [FoldTimings(keystrokes), FoldTimings(attempts)]:
+            for holdout_user in keystrokes.keys():
+                expected = filter_timings(parse_data(dict((user, user_data) for user, user_data in keystrokes.items()
+                                                          if user != holdout_user)))
+                actual = folds.training_timings(holdout_user)
+
+                self.assertEqual(dict((bigram, sorted(timing)) for bigram, timing in actual.items()),
+                                 dict((bigram, sorted(timing)) for bigram, timing in expected.items()))
+
+
+class ProfilingTest(unittest.TestCase):
+    def setUp(self):
+        # record into fresh counters and timers, without tracing memory, and put everything back afterwards
+        self.recording = profiling.enabled, profiling.counters, profiling.timers
+        profiling.enabled, profiling.counters, profiling.timers = True, {}, {}
+
+    def tearDown(self):
+        profiling.enabled, profiling.counters, profiling.timers = self.recording
+
+    def test_since_and_merge_round_trip(self):
+        profiling.count("test.rows", 5)
+        profiling.add_time("test.stage", 2.0)
+        profiling.add_time("test.idle", 1.0)
+        before = profiling.snapshot()
+
+        # what a worker records over one fold
+        profiling.count("test.rows", 3)
+        profiling.count("test.fits")
+        profiling.add_time("test.stage", 0.5)
+        profiling.add_time("test.fold", 1.5)
+        fold = profiling.since(before)
+
+        self.assertEqual(fold["counters"], {"test.rows": 3, "test.fits": 1})
+        self.assertEqual(sorted(fold["timers"].keys()), ["test.fold", "test.stage"])
+        self.assertEqual(fold["timers"]["test.stage"]["calls"], 1)
+        self.assertAlmostEqual(fold["timers"]["test.stage"]["seconds"], 0.5)
+
+        # merged into a process that only has what came before, the fold adds back up to the whole
+        whole = profiling.snapshot()
+        profiling.counters, profiling.timers = before["counters"], before["timers"]
+        profiling.merge(fold)
+        merged = profiling.snapshot()
+
+        self.assertEqual(merged["counters"], whole["counters"])
+        self.assertEqual(sorted(merged["timers"].keys()), sorted(whole["timers"].keys()))
+        for name, entry in whole["timers"].items():
+            self.assertEqual(merged["timers"][name]["calls"], entry["calls"])
+            self.assertAlmostEqual(merged["timers"][name]["seconds"], entry["seconds"])
+            self.assertEqual(merged["timers"][name]["longest_seconds"], entry["longest_seconds"])
+
+    def test_nothing_recorded_when_disabled(self):
+        profiling.enabled = False
+        profiling.count("test.rows")
+        with profiling.timer("test.stage"):
+            pass
+
+        self.assertEqual(profiling.snapshot(), {"counters": {}, "timers": {}})
+
+
+class InferenceTest(unittest.TestCase):
+    def run_inference(self, jobs):
+        with cd(run_directory()):
+            inference.main(argparse.Namespace(jobs=jobs, model="gamma", warm_start=False, no_fit_cache=False, profile=None))
+            with open('new.out') as f:
+                return f.read()
+
+    def test_jobs_keep_user_order(self):
+        serial = self.run_inference(1)
+        self.assertEqual(self.run_inference(2), serial)
+        self.assertEqual(self.run_inference(3), serial)
+
+        # every fold, one after another in user order
+        attempts = CleanedAttempts.from_attempts(stream_clean_data(retrieve_data_chunks(database)))
+        inference.init_folds(attempts, FoldTimings(attempts))
+        self.assertEqual(serial.strip(), str([inference.run_fold(user) for user in sorted(str(user) for user in attempts.user_names)]))
+
+
+class TimingStatsTest(unittest.TestCase):
+    def arguments(self, jobs=1):
+        return argparse.Namespace(superlist="dist_sets", output_plot="plot", plot_title="PDF of key latencies",
+                                  text_output="stats", a=True, i=True, m=True, r=False, jobs=jobs, profile=None)
+
+    ##
+    # @input path - a directory timing_stats.py ran in
+    # @returns a dictionary connecting every text report written to its contents, and a sorted list of every plot saved
+    def outputs(self, path):
+        reports = {}
+        for name in os.listdir(os.path.join(path, 'outputs')):
+            if name.endswith('.out'):
+                with open(os.path.join(path, 'outputs', name)) as f:
+                    reports[name] = f.read()
+        return reports, sorted(os.listdir(os.path.join(path, 'outputs', 'plots')))
+
+    def test_parallel_reports_match_serial(self):
+        written = []
+        for jobs in [1, 2]:
+            path = run_directory()
+            with cd(path):
+                timing_stats.main_per_user(self.arguments(jobs))
+            written.append(self.outputs(path))
+
+        reports, plots = written[0]
+        self.assertEqual(sorted(reports.keys()), ["stats.%d.out" % (i + 1) for i in range(4)])
+        self.assertEqual(plots, ["plot.%d.png" % (i + 1) for i in range(4)])
+        self.assertEqual(written[1], written[0])
+
+    def test_one_load_feeds_both_modes(self):
+        loads = []
+        load = timing_stats.obtain_timings
+        timing_stats.obtain_timings = lambda: loads.append(1) or load()
+        try:
+            path = run_directory()
+            with cd(path):
+                timing_stats.main(self.arguments())
+        finally:
+            timing_stats.obtain_timings = load
+
+        self.assertEqual(len(loads), 1)
+        reports, plots = self.outputs(path)
+        self.assertEqual(sorted(reports.keys()), ["stats.%d.out" % (i + 1) for i in range(4)] + ["stats.out"])
+
+    def test_modes_leave_timings_untouched(self):
+        store = TimingStore.from_attempts(CleanedAttempts.from_attempts(stream_clean_data(retrieve_data_chunks(database))))
+        columns = store.timings.copy(), store.bigrams.copy(), store.users.copy()
+
+        with cd(run_directory()):
+            timing_stats.main_all(self.arguments(), store)
+            timing_stats.main_per_user(self.arguments(), store)
+
+        for before, after in zip(columns, (store.timings, store.bigrams, store.users)):
+            np.testing.assert_array_equal(after, before)
+
+
+class SplitRankTest(unittest.TestCase):
+    def test_matches_rank_pins(self):
+        rng = np.random.RandomState(0)
+        for length in [1, 4, 5]:
+            for timings in TIMINGS:
+                densities = model.log_densities((list(timings) * 2)[:length])
+                scores = score_pins(densities)
+                for pin in rng.randint(0, 10 ** length, 20):
+                    self.assertEqual(split_rank(densities, pin), rank_pins(scores, pin)[0])
+
+    def test_ties_rank_in_ascending_order(self):
+        densities = np.zeros((5, len(distance_classes)))
+        for pin in [0, 1, 4321, 99999]:
+            self.assertEqual(split_rank(densities, pin), pin)
+
+
+class CandidateListTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(directory, "candidates.txt")
+        write_candidates(self.path, range(10 ** 4))
+
+    def test_rank_matches_top_pins_and_rank_pins(self):
+        candidates = CandidateList(self.path)
+        for timings in TIMINGS:
+            scores = score_pins(model.log_densities(timings))
+            for target in [0, 1234, "0042", 9999]:
+                best, rank = candidates.rank(model, timings, 12, target, chunk_size=777)
+
+                self.assertEqual([pin for pin, score in best], ["%04d" % pin for pin in top_pins(scores, 12)])
+                np.testing.assert_allclose([score for pin, score in best], scores[top_pins(scores, 12)])
+                self.assertEqual(rank, rank_pins(scores, int(target))[0])
+
+    def test_position(self):
+        candidates = CandidateList(self.path)
+        self.assertEqual(candidates.position(42), 42)
+        self.assertEqual(candidates.position("0042"), 42)
+        self.assertEqual(candidates.position("42"), None)
+        self.assertRaises(ValueError, candidates.position, "12a4")
+
+    def test_digit_scores_match_score_pins(self):
+        pins = np.array([0, 42, 1234, 9999])
+        for timings in TIMINGS:
+            densities = model.log_densities(timings)
+            scores = score_pins(densities)
+
+            np.testing.assert_allclose(digit_scores(densities, pin_digits(4)), scores)
+            np.testing.assert_allclose(pin_scores(densities, pins), scores[pins])
+            # every PIN is its first digit followed by one of the endings of that digit
+            for first in range(10):
+                np.testing.assert_allclose(digit_scores(densities[:1], np.array([[first]])) + suffix_scores(densities[1:], first),
+                                           scores[first * 1000:(first + 1) * 1000])
+
+
+class CleanDataTest(unittest.TestCase):
+    def test_stream_matches_clean_data(self):
+        expected = clean_data(preprocess_data(retrieve_data(database, []), presorted=True))
+        rejected = {}
+        actual = CleanedAttempts.from_attempts(stream_clean_data(retrieve_data_chunks(database, [], chunk_size=97),
+                                                                 rejected)).to_keystrokes()
+
+        self.assertEqual(sorted(actual.keys()), sorted(expected.keys()))
+        for user in expected:
+            self.assertEqual(dict(actual[user]), dict(expected[user]))
+        self.assertGreater(rejected["backspace"] + rejected["incorrect"], 0)
+
+    def test_is_correct_pin(self):
+        typed = lambda keys: [(key, 0) for key in keys]
+        self.assertTrue(is_correct_pin(typed("0012"), 12))
+        self.assertTrue(is_correct_pin(typed("123456"), 123456))
+        self.assertFalse(is_correct_pin(typed("001234"), 1234))
+        self.assertFalse(is_correct_pin(typed("00123"), 123))
+        self.assertFalse(is_correct_pin(typed("0000000123"), 123))
+        self.assertFalse(is_correct_pin(typed("012"), 12))
+        self.assertFalse(is_correct_pin(typed("1234"), 123456))
+        self.assertFalse(is_correct_pin(typed(""), 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,18 @@
 # Python code that calculates statistics on data collected
 
 import matplotlib
+# only ever render to files, which also lets users be rendered in separate processes
+matplotlib.use('Agg')
 from common import *
+from attempt_cache import load_attempts
+from timing_store import TimingStore
+from set_statistics import SetStatistics, BIN_EDGES, t_test_matrix
 from matplotlib.ticker import FuncFormatter
-from collections import defaultdict
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from multiprocessing import Pool
 from scipy import stats
+import profiling
 import matplotlib.pyplot as plt
 import matplotlib.mlab as mlab
 import numpy as np
@@ -19,83 +27,50 @@ import argparse
 #           where the dictionaries connect keypairs (e.g. "12")
 #           to every interkey timing used to enter it by a given user
 def parse_data_per_user(keystrokes):
-    collector = []
-
-    for user, user_data in keystrokes.items():
-        all_timings = defaultdict(lambda: [])
-        for pin, pin_data in user_data.items():
-            entry_bigrams = []
-
-            # collect every bigram from all attempts
-            for attempt in pin_data:
-                entry_bigrams.extend([(key_a + key_b, times_b - times_a) for ((key_a, times_a), (key_b, times_b)) in zip(attempt[:-1], attempt[1:])])
-
-            # put bigrams in the dictionary and convert Python timedelta objects to integers
-            for (bigram, time_diff) in entry_bigrams:
-                time_diff_in_ms = int(math.floor(((time_diff.seconds * (10**6)) + time_diff.microseconds) / (10**3)))
-                all_timings[bigram].append(time_diff_in_ms)
-        collector.append(all_timings)
-
-    return collector
+    return [parse_data({user: user_data}) for user, user_data in keystrokes.items()]
 
 ##
 # This function roots out the highest X% of data as outliers, while keeping data separate per user
 #
-# @input timings - a list of dictionaries of lists of ints, where the dictionaries
+# @input timings - a TimingStore of every user (whose cutoffs are then all found in one go),
+#                   or a list of dictionaries of lists of ints, where the dictionaries
 #                   connect keypairs (e.g. "12") to every interkey
 #                   timing used to enter it by a single user
 # @input percentile - the threshold above which data gets thrown out
 #                       (defaults to 95th, as in top 5% gets thrown out)
-# @returns a list of dictionaries of lists of ints,
-#           where the dictionaries connect keypairs (e.g. "12")
+# @returns a list of TimingStores (or of dictionaries of lists of ints),
+#           which connect keypairs (e.g. "12")
 #           to every interkey timing used by a single user to enter it (without outliers)
 def filter_timings_per_user(timings, percentile=95):
-    ret = []
+    if hasattr(timings, 'per_user'):
+        filtered = timings.filtered(percentile, "user")
+        profiling.count("common.timings_dropped_by_filter", timings.timings.shape[0] - filtered.timings.shape[0])
+        return filtered.per_user()
 
-    for user_data in timings:
-        # get just the timings to figure out percentiles on them
-        just_the_timings = [timing for bigram, set_of_timings in user_data.items() for timing in set_of_timings]
-        bar = np.percentile(just_the_timings, percentile)
-
-        # filter out all timings which fall below the threshold
-        good_pairs = [(bigram, list(filter(lambda x: x < bar, timing))) for bigram, timing in user_data.items()]
-        curr = defaultdict(lambda: [])
-
-        # put our new timings back together in the dictionary
-        for (bigram, timing) in good_pairs:
-            curr[bigram] = (timing)
-        ret.append(curr)
-
-    return ret
+    return [filter_timings(user_data, percentile) for user_data in timings]
 
 
 ##
 # This function combines all functionalities pertaining obtaining and cleaning data
 #
-# @returns a dictionary of ints,
-#           where the dictionary connects a keypair (e.g. "12")
+# @returns a TimingStore, which connects a keypair (e.g. "12")
 #           to every interkey timing used to enter it
+@profiling.timed("timing_stats.obtain_timings")
 def obtain_timings():
-    raw_data = retrieve_data()
-    keystrokes = preprocess_data(raw_data)
-    keystrokes = clean_data(keystrokes)
-    timings = parse_data(keystrokes)
+    attempts = load_attempts()
+    timings = TimingStore.from_attempts(attempts)
 
     return timings
 
 ##
-# This function combines all functionalities pertaining obtaining and cleaning data, but on a per user level
+# This function combines all functionalities pertaining obtaining and cleaning data, but on a per user level.
+# Every timing in a TimingStore is tagged with its user, so this is the same data as obtain_timings
 #
-# @returns a dictionary of ints,
-#           where the dictionary connects a keypair (e.g. "12")
-#           to every interkey timing used to enter it
+# @returns a TimingStore of every user, which connects a keypair (e.g. "12")
+#           to every interkey timing used to enter it; filter_timings_per_user
+#           splits it into one TimingStore per user
 def obtain_timings_per_user():
-    raw_data = retrieve_data()
-    keystrokes = preprocess_data(raw_data)
-    keystrokes = clean_data(keystrokes)
-    timings = parse_data_per_user(keystrokes)
-
-    return timings
+    return obtain_timings()
 
 
 ##
@@ -103,18 +78,24 @@ def obtain_timings_per_user():
 #
 # @input timings - a dictionary of keypairs with their timings
 # @input given_set - what set of keypairs to test
-def relevance_within_set(timings, given_set, name_of_set, user):
-    print "P-value within " + name_of_set + " for user " + user
-    print "---"
+# @input out - the file to write to (defaults to stdout)
+# @returns the list of keypairs tested, and a pair of matrices of the t statistic and p value
+#           between every two of them (see set_statistics.welch_t_tests)
+def relevance_within_set(timings, given_set, name_of_set, user, out=None):
+    print >>out, "P-value within " + name_of_set + " for user " + user
+    print >>out, "---"
 
     # only test the keypairs we actually have data for
     active_set = [x for x in given_set if x in timings.keys()]
-    test_pairs = itertools.combinations(active_set, 2)
-    
-    for x, y in test_pairs:
-        t_statistic, p_value = stats.ttest_ind(timings[x], timings[y], equal_var=False)
-        print "keypair 1: %s\nkeypair 2: %s\nt: %f\np value: %f\n" % (x, y, t_statistic, p_value)
-    print ""
+
+    # test every two keypairs at once
+    t_statistics, p_values = t_test_matrix([SetStatistics(timings, [x]) for x in active_set])
+
+    for i, j in itertools.combinations(range(len(active_set)), 2):
+        print >>out, "keypair 1: %s\nkeypair 2: %s\nt: %f\np value: %f\n" % (active_set[i], active_set[j], t_statistics[i, j], p_values[i, j])
+    print >>out, ""
+
+    return active_set, t_statistics, p_values
 
 ##
 # This function only serves to make things look prettier for the histograms
@@ -137,18 +118,19 @@ def to_percent(y, position):
 # @input given_set - the set to find the mean and standard deviations
 # @input name_of_set - a string denoting the name of the set
 # @input user - a string identifying the user
-def mean_std_of_set(timings, given_set, name_of_set, user):
-    print "Mean and STD of " + name_of_set + " for user " + user
-    print "---"
+# @input out - the file to write to (defaults to stdout)
+# @input statistics - the SetStatistics of the set, if already made
+def mean_std_of_set(timings, given_set, name_of_set, user, out=None, statistics=None):
+    print >>out, "Mean and STD of " + name_of_set + " for user " + user
+    print >>out, "---"
 
-    # only test the keypairs we actually have data for
-    active_set = [timings[x] for x in given_set]
-    active_set = [item for sublist in active_set for item in sublist]
-    
-    std = np.std(active_set)
-    mean = np.mean(active_set)
+    if statistics is None:
+        statistics = statistics_of_sets(timings, [name_of_set])[name_of_set]
+
+    std = statistics.get_std()
+    mean = statistics.get_mean()
 
-    print "mean: %f\nstandard deviation: %f\n" % (mean, std)
+    print >>out, "mean: %f\nstandard deviation: %f\n" % (mean, std)
 
 ##
 # This function produces a histogram for a given set
@@ -156,101 +138,106 @@ def mean_std_of_set(timings, given_set, name_of_set, user):
 # @input timings - the set of all timings
 # @input given_set - the set to produce a histogram for
 # @input name_of_set - a string denoting the name of the set
-# @input user - a string identifying the user
-def hist_of_set(timings, given_set, name_of_set, show_model, show_raw):
-    with cd('plots'):
-        # only test the keypairs we actually have data for
-        active_set = [timings[x] for x in given_set]
-        active_set = [item for sublist in active_set for item in sublist]
-        num = len(active_set)
-
-        # if no data, don't bother plotting anything
-        if not bool(active_set):
-            return
-
-        # Fit a gamma distribution to the data observed
-        alpha, loc, beta = stats.gamma.fit(active_set)
-        scale = beta ** (-1)
-        x = np.linspace(0, 650, 1000)
-        model_name = name_of_set
-
-        ##
-        # this is a hack so that we can always make sure that
-        # the same class gets the same color, independent of run
-        color = {
-            "dist_zero": "black",
-
-            "dist_one": "red",
-            "dist_one_horizontal": "green",
-            "dist_one_vertical": "blue",
-            "dist_one_up": "black",
-            "dist_one_right": "orange",
-            "dist_one_down": "cyan",
-            "dist_one_left": "purple",
-
-            "dist_two": "blue",
-            "dist_two_horizontal": "green",
-            "dist_two_vertical": "red",
-            "dist_two_up": "black",
-            "dist_two_right": "orange",
-            "dist_two_down": "cyan",
-            "dist_two_left": "purple",
-
-            "dist_three": "green",
-            "dist_three_up": "red",
-            "dist_three_down": "blue",
-
-            "dist_diagonal_one": "magenta",
-            "dist_dogleg": "orange",
-            "dist_long_dogleg": "cyan",
-            "dist_diagonal_two": "purple",
-
-            "zero_to_enter": "red",
-            "one_to_enter": "magenta",
-            "two_to_enter": "goldenrod",
-            "three_to_enter": "orange",
-            "four_to_enter": "pink",
-            "five_to_enter": "cyan",
-            "six_to_enter": "blue",
-            "seven_to_enter": "purple",
-            "eight_to_enter": "green",
-            "nine_to_enter": "black"
-        }
-
-        # plot the gamma distribution model of the data
-        if show_model:
-            plt.plot(x,stats.gamma.pdf(x, alpha, loc=loc, scale=beta),'-', color=color[name_of_set],label=model_name)
-
-        # force the histogram bin edges to always fall on multiples of 25, from 50 to 625
-        bin_setter = [50, 75, 100, 125, 150, 175, 200, 225, 250, 275, 300, 325, 350, 375, 400, 425, 450, 475, 500, 525, 550, 575, 600, 625]
-        ys, binEdges = np.histogram(active_set, bins=bin_setter, normed=True)
+# @input show_model - whether to plot the gamma distribution fit to the set
+# @input show_raw - whether to plot the histogram of the set
+# @input ax - the axes to plot on (defaults to the current pyplot axes)
+# @input statistics - the SetStatistics of the set, if already made
+def hist_of_set(timings, given_set, name_of_set, show_model, show_raw, ax=None, statistics=None):
+    if ax is None:
+        ax = plt.gca()
+
+    if statistics is None:
+        statistics = statistics_of_sets(timings, [name_of_set])[name_of_set]
+    num = statistics.get_n()
+
+    # if no data, don't bother plotting anything
+    if num == 0:
+        return
+
+    x = np.linspace(0, 650, 1000)
+    model_name = name_of_set
+
+    ##
+    # this is a hack so that we can always make sure that
+    # the same class gets the same color, independent of run
+    color = {
+        "dist_zero": "black",
+
+        "dist_one": "red",
+        "dist_one_horizontal": "green",
+        "dist_one_vertical": "blue",
+        "dist_one_up": "black",
+        "dist_one_right": "orange",
+        "dist_one_down": "cyan",
+        "dist_one_left": "purple",
+
+        "dist_two": "blue",
+        "dist_two_horizontal": "green",
+        "dist_two_vertical": "red",
+        "dist_two_up": "black",
+        "dist_two_right": "orange",
+        "dist_two_down": "cyan",
+        "dist_two_left": "purple",
+
+        "dist_three": "green",
+        "dist_three_up": "red",
+        "dist_three_down": "blue",
+
+        "dist_diagonal_one": "magenta",
+        "dist_dogleg": "orange",
+        "dist_long_dogleg": "cyan",
+        "dist_diagonal_two": "purple",
+
+        "zero_to_enter": "red",
+        "one_to_enter": "magenta",
+        "two_to_enter": "goldenrod",
+        "three_to_enter": "orange",
+        "four_to_enter": "pink",
+        "five_to_enter": "cyan",
+        "six_to_enter": "blue",
+        "seven_to_enter": "purple",
+        "eight_to_enter": "green",
+        "nine_to_enter": "black"
+    }
+
+    # plot the gamma distribution model of the data (only fitting one when it gets plotted)
+    if show_model:
+        alpha, loc, beta = statistics.get_gamma()
+        ax.plot(x,stats.gamma.pdf(x, alpha, loc=loc, scale=beta),'-', color=color[name_of_set],label=model_name)
+
+    # the histogram bin edges always fall on multiples of 25, from 50 to 625
+    ys = statistics.get_density()
+    binEdges = BIN_EDGES
+
+    ##
+    # xs should be the middle of the bin
+    # (and using binEdges for this means that we can guarantee len(xs) == len(ys))
+    xs = [(x + y) / 2 for x, y in zip(binEdges[:-1], binEdges[1:])]
+    name = name_of_set + "\nn = " + str(num)
+
+    # here we plot a rough fit to the histogram, so that multiple overlapping distributions can be seen at once
+    if show_raw or not show_model:
+        ax.plot(xs, ys,'-', color=color[name_of_set], label=name)
 
-        ##
-        # xs should be the middle of the bin
-        # (and using binEdges for this means that we can guarantee len(xs) == len(ys))
-        xs = [(x + y) / 2 for x, y in zip(binEdges[:-1], binEdges[1:])]
-        name = name_of_set + "\nn = " + str(num)
-
-        # here we plot a rough fit to the histogram, so that multiple overlapping distributions can be seen at once
-        if show_raw or not show_model:
-            plt.plot(xs, ys,'-', color=color[name_of_set], label=name)
-    
 ##
 # This function tests whether two given sets have significantly different timings from one another
 #
 # @input timings - a dictionary of keypairs with their timings
 # @input set_a - the first set of keypairs to test
 # @input set_b - the first set of keypairs to test
-def relevance_between_sets(timings, set_a, name_a, set_b, name_b):
+# @input out - the file to write to (defaults to stdout)
+# @input statistics_a - the SetStatistics of the first set, if already made
+# @input statistics_b - the SetStatistics of the second set, if already made
+def relevance_between_sets(timings, set_a, name_a, set_b, name_b, out=None, statistics_a=None, statistics_b=None):
     # collect all timings from all keypairs in the sets
-    timings_for_a = [timings[x] for x in set_a]
-    timings_for_a = [item for sublist in timings_for_a for item in sublist]
-
-    timings_for_b = [timings[x] for x in set_b]
-    timings_for_b = [item for sublist in timings_for_b for item in sublist]
+    if statistics_a is None:
+        statistics_a = SetStatistics(timings, set_a)
+    if statistics_b is None:
+        statistics_b = SetStatistics(timings, set_b)
 
-    t_statistic, p_value = stats.ttest_ind(timings_for_a, timings_for_b, equal_var=False)
-    print "%s vs. %s\nt: %f\np value: %f\n" % (name_a, name_b, t_statistic, p_value)
+    t_statistics, p_values = t_test_matrix([statistics_a, statistics_b])
+    t_statistic, p_value = t_statistics[0, 1], p_values[0, 1]
+    print >>out, "%s vs. %s\nt: %f\np value: %f\n" % (name_a, name_b, t_statistic, p_value)
 
 ##
 # This function compares every combination of two sets within a superset,
@@ -259,116 +246,184 @@ def relevance_between_sets(timings, set_a, name_a, set_b, name_b):
 # @input timings - a dictionary of keypairs with their timings
 # @input set_a - the first set of keypairs to test
 # @input set_b - the first set of keypairs to test
-def relevance_between_sets_from_superset(timings, superset):
-    for name_a, name_b in itertools.combinations(superset, 2):
-        relevance_between_sets(timings, all_sets[name_a], name_a, all_sets[name_b], name_b)
+# @input out - the file to write to (defaults to stdout)
+# @input statistics - a dictionary connecting names of sets to their SetStatistics, if already made
+# @returns a pair of matrices of the t statistic and p value between every two sets,
+#           in the order of the superset (see set_statistics.welch_t_tests)
+def relevance_between_sets_from_superset(timings, superset, out=None, statistics=None):
+    if statistics is None:
+        statistics = statistics_of_sets(timings, superset)
+
+    # test every two sets at once
+    t_statistics, p_values = t_test_matrix([statistics[name] for name in superset])
+
+    for i, j in itertools.combinations(range(len(superset)), 2):
+        print >>out, "%s vs. %s\nt: %f\np value: %f\n" % (superset[i], superset[j], t_statistics[i, j], p_values[i, j])
+
+    return t_statistics, p_values
+
+##
+# This function gathers the statistics of every set in a superset. Distance classes
+# are grouped all at once through distance_class_table; any other set (e.g. "dist_one_left")
+# gathers its own keypairs
+#
+# @input timings - a dictionary of keypairs with their timings (or a TimingStore)
+# @input superset - a list of names of sets
+# @returns a dictionary connecting the name of every set to its SetStatistics
+def statistics_of_sets(timings, superset):
+    by_class = class_timings(timings) if any(name in distance_class_ids for name in superset) else None
+    return dict((name, SetStatistics(timings, all_sets[name],
+                                     by_class[distance_class_ids[name]] if name in distance_class_ids else None))
+                for name in superset)
+
+##
+# This function writes the text report and plot of one set of timings, to explicit paths
+# and on its own figure, so that reports can be rendered in any process
+#
+# @input timings - a dictionary of keypairs with their timings (or a TimingStore)
+# @input args - the arguments timing_stats.py was run with
+# @input text_path - the file to write the text report to
+# @input plot_path - the file to save the plot to
+# @input heading - the first line of the text report (e.g. "Analyzing all users:")
+# @input user - a string identifying the user, in the text report
+# @input title - the end of the title of the plot (e.g. " across all users")
+# @input xlim - the largest interkey time shown in the plot
+def render_report(timings, args, text_path, plot_path, heading, user, title, xlim):
+    flag_no_print = args.text_output == ""
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    # every statistic of a set is worked out once, and shared by everything below
+    statistics = statistics_of_sets(timings, list_of_lists[args.superlist])
+
+    with open(text_path, 'w') as out:
+        if not flag_no_print:
+            print >>out, heading + "\n"
+            print >>out, "~~~~~~~~~~~~~~~~~~~~~~\n"
+
+        for name in list_of_lists[args.superlist]:
+            hist_of_set(timings, all_sets[name], name, args.m, args.r, ax, statistics[name])
+            if not flag_no_print:
+                mean_std_of_set(timings, all_sets[name], name, user, out, statistics[name])
+
+        ##
+        # Create the formatter using the function to_percent. This multiplies all the
+        # default labels by 100, making them all percentages
+        formatter = FuncFormatter(to_percent)
+
+        # Set the formatter
+        ax.yaxis.set_major_formatter(formatter)
+
+        # Labels on the graph
+        ax.set_ylabel('Frequency')
+        ax.set_xlabel('Interkey Time in ms')
+        ax.set_title(args.plot_title + title)
+        ax.set_xlim([0,xlim])
+        ax.grid(True)
+        legend = ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+
+        fig.savefig(plot_path, bbox_extra_artists=(legend,), bbox_inches='tight')
+
+        if not flag_no_print:
+            print >>out, "~~~~~~~~~~~~~~~~~~~~~~\n"
+            print >>out, "Calculating differences between sets:"
+            print >>out, "---\n"
+            relevance_between_sets_from_superset(timings, list_of_lists[args.superlist], out, statistics)
 
 ##
 # Perform all functionality with data from all users
-def main_all(args):
-    timings = obtain_timings()
+#
+# @input args - the arguments timing_stats.py was run with
+# @input timings - the TimingStore of every user, if already loaded
+@profiling.timed("timing_stats.main_all")
+def main_all(args, timings=None):
+    if timings is None:
+        timings = obtain_timings()
     timings = filter_timings(timings)
-    
-    flag_no_print = args.text_output == ""
-    
-    if flag_no_print:
+
+    if args.text_output == "":
         file_out = "all_users"
     else:
         file_out = args.text_output
 
-    with cd('outputs'):
-        with change_stdout(file_out + '.out'):
-            if not flag_no_print:
-                print "Analyzing all users:\n"
-                print "~~~~~~~~~~~~~~~~~~~~~~\n"
-
-            for name in list_of_lists[args.superlist]:
-                hist_of_set(timings, all_sets[name], name, args.m, args.r)
-                if not flag_no_print:
-                    mean_std_of_set(timings, all_sets[name], name, "ALL")
-
-            ##
-            # Create the formatter using the function to_percent. This multiplies all the
-            # default labels by 100, making them all percentages
-            formatter = FuncFormatter(to_percent)
-
-            # Set the formatter
-            plt.gca().yaxis.set_major_formatter(formatter)
-
-            # Labels on the graph
-            plt.ylabel('Frequency')
-            plt.xlabel('Interkey Time in ms')
-            plt.title(args.plot_title + " across all users")
-            plt.xlim([0,650])
-            plt.grid(True)
-            legend = plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-
-            with cd('plots'):
-                plt.savefig(args.output_plot + '.png', bbox_extra_artists=(legend,), bbox_inches='tight')
-            plt.clf()
+    render_report(timings, args,
+                  os.path.join('outputs', file_out + '.out'),
+                  os.path.join('outputs', 'plots', args.output_plot + '.png'),
+                  "Analyzing all users:", "ALL", " across all users", 650)
 
-            if not flag_no_print:
-                print "~~~~~~~~~~~~~~~~~~~~~~\n"
-                print "Calculating differences between sets:"
-                print "---\n"
-                relevance_between_sets_from_superset(timings, list_of_lists[args.superlist])
+##
+# This function gets a process ready to render the reports of users
+#
+# @input profile - whether to record timers and counters while rendering
+def init_rendering(profile=False):
+    if profile and not profiling.enabled:
+        profiling.enable()
 
 ##
-# Perform all functionality with data from individual users
-def main_per_user(args):
-    timings = obtain_timings_per_user()
-    timings = filter_timings_per_user(timings)
+# This function renders the report of one user
+#
+# @input task - a tuple of (number of the user, counting from 1, name of the user, timings of the user, arguments of the run)
+# @returns what profiling recorded while rendering, to be added up by the process that asked for it
+def render_user(task):
+    i, user, user_data, args = task
+    before = profiling.snapshot()
 
-    flag_no_print = args.text_output == ""
-    
-    if flag_no_print:
+    if args.text_output == "":
         file_out = "user"
     else:
         file_out = args.text_output
 
-    i = 1
-
-    for user_data in timings:
-        with cd('outputs'):
-            with change_stdout(file_out + '.' + str(i) + '.out'):
-                if not flag_no_print:
-                    print "Analyzing user " + str(i) + ":\n"
-                    print "~~~~~~~~~~~~~~~~~~~~~~\n"
-
-                for name in list_of_lists[args.superlist]:
-                    hist_of_set(user_data, all_sets[name], name, args.m, args.r)
-                    if not flag_no_print:
-                        mean_std_of_set(user_data, all_sets[name], name, str(i))
-
-                ##
-                # Create the formatter using the function to_percent. This multiplies all the
-                # default labels by 100, making them all percentages
-                formatter = FuncFormatter(to_percent)
-
-                # Set the formatter
-                plt.gca().yaxis.set_major_formatter(formatter)
-
-                # Labels on the graph
-                plt.ylabel('Frequency')
-                plt.xlabel('Interkey Time in ms')
-                plt.title(args.plot_title + " for user " + str(i))
-                plt.xlim([0,750])
-                plt.grid(True)
-                legend = plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-
-                with cd('plots'):
-                    plt.savefig(args.output_plot + '.' + str(i) + '.png', bbox_extra_artists=(legend,), bbox_inches='tight')
-                plt.clf()
-
-                if not flag_no_print:
-                    print "~~~~~~~~~~~~~~~~~~~~~~\n"
-                    print "Calculating differences between sets:"
-                    print "---\n"
-                    relevance_between_sets_from_superset(user_data, list_of_lists[args.superlist])
-
-                i += 1
-
-# python timing_stats.py [-a] [-i] [-m] [-r] <superlist> <output_plot> [--plot_title "title of the plot"] [--text_output <text_output_file>]
+    with profiling.timer("timing_stats.render_user"):
+        render_report(user_data, args,
+                      os.path.join('outputs', file_out + '.' + str(i) + '.out'),
+                      os.path.join('outputs', 'plots', args.output_plot + '.' + str(i) + '.png'),
+                      "Analyzing user " + str(i) + " (" + user + "):", str(i), " for user " + str(i), 750)
+
+    return profiling.since(before)
+
+##
+# Perform all functionality with data from individual users
+#
+# @input args - the arguments timing_stats.py was run with
+# @input timings - the TimingStore of every user, if already loaded
+@profiling.timed("timing_stats.main_per_user")
+def main_per_user(args, timings=None):
+    if timings is None:
+        timings = obtain_timings_per_user()
+    user_names = list(timings.user_names)
+    timings = dict(zip(user_names, filter_timings_per_user(timings)))
+
+    # number users in the order a dictionary of every user lists them in, as the reports always have been
+    tasks = [(i + 1, user, timings[user], args) for i, user in enumerate(dict.fromkeys(user_names))]
+
+    if args.jobs > 1:
+        pool = Pool(args.jobs, initializer=init_rendering, initargs=(profiling.enabled,))
+        try:
+            for user_profile in pool.imap_unordered(render_user, tasks):
+                profiling.merge(user_profile)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            render_user(task)
+
+##
+# Perform every mode the run asks for, loading the timings once for all of them
+#
+# @input args - the arguments timing_stats.py was run with
+def main(args):
+    # each mode filters its own view, leaving these untouched
+    timings = obtain_timings()
+
+    if args.a or not args.i:
+        main_all(args, timings)
+    if args.i:
+        main_per_user(args, timings)
+
+# python timing_stats.py [-a] [-i] [-m] [-r] <superlist> <output_plot> [--plot_title "title of the plot"] [--text_output <text_output_file>] [--jobs N] [--profile [FILE]]
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Specify arguments')
     parser.add_argument('superlist', help='what list of keypair sets to compare')
@@ -379,9 +434,16 @@ if __name__ == "__main__":
     parser.add_argument('-i', help='individual users mode', action="store_true")
     parser.add_argument('-m', help='gamma model mode', action="store_true")
     parser.add_argument('-r', help='raw data mode', action="store_true")
+    parser.add_argument('--jobs', help='number of processes to render individual users on', type=int, default=1)
+    parser.add_argument('--profile', help='write timers and counters of the run to a JSON file (default profile.json)',
+                        nargs='?', const='profile.json', default=None)
     args = parser.parse_args()
 
-    if args.a or not args.i:
-        main_all(args)
-    if args.i:
-        main_per_user(args)
+    if args.profile is not None:
+        profiling.enable()
+
+    main(args)
+
+    if args.profile is not None:
+        profiling.write_report(args.profile)
+        print "profile written to " + args.profile
@@ -0,0 +1,241 @@
+##
+# TimingStore class that holds interkey timings as flat arrays, in place of
+# dictionaries of lists of ints
+##
+from common import KEYPAD, key_index, all_sets, distance_classes, distance_class_ids, distance_class_table
+import numpy as np
+import profiling
+
+NUM_KEYS = len(KEYPAD)
+NUM_BIGRAMS = NUM_KEYS * NUM_KEYS
+
+# the keypair (e.g. "12") of every bigram code, where a code is key_index[from] * NUM_KEYS + key_index[to]
+BIGRAMS = [from_key + to_key for from_key in KEYPAD for to_key in KEYPAD]
+
+# the distance class of every bigram code, with keypairs outside every class put after all of them
+BIGRAM_CLASSES = np.where(distance_class_table.ravel() < 0, len(distance_classes), distance_class_table.ravel()).astype(np.int64)
+
+##
+# @input keypair - a keypair (e.g. "12")
+# @returns the bigram code of the keypair, or -1 if it isn't made of keypad keys
+def bigram_code(keypair):
+    if len(keypair) != 2 or keypair[0] not in key_index or keypair[1] not in key_index:
+        return -1
+    return key_index[keypair[0]] * NUM_KEYS + key_index[keypair[1]]
+
+##
+# This function finds a percentile of every group of values at once, interpolating
+# between order statistics the same way np.percentile does
+#
+# @input values - an array of values
+# @input groups - an array of the group (from 0 to num_groups - 1) of every value
+# @input num_groups - the number of groups
+# @input percentile - the percentile to find
+# @returns an array of the percentile of every group (NaN for empty groups)
+def group_percentiles(values, groups, num_groups, percentile):
+    order = np.lexsort((values, groups))
+    ordered = values[order]
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    res = np.full(num_groups, np.nan)
+    present = counts > 0
+
+    index = (percentile / 100.0) * (counts[present] - 1)
+    index_below = np.floor(index).astype(np.int64)
+    index_above = np.minimum(index_below + 1, counts[present] - 1)
+
+    below = ordered[starts[present] + index_below].astype(float)
+    above = ordered[starts[present] + index_above].astype(float)
+    res[present] = below + (above - below) * (index - index_below)
+
+    return res
+
+
+class TimingStore:
+    ##
+    # Constructor for a store of timings. Timings are kept grouped by distance class and then
+    # by bigram (each group in the order it was given), so that every bigram and every
+    # distance class is a contiguous slice
+    #
+    # @input timings - an array of interkey timings in ms
+    # @input bigrams - an array of the bigram code of every timing
+    # @input users - an array of the index (into user_names) of the user of every timing
+    # @input user_names - a list of every user
+    # @input grouped - whether the timings are already grouped (only for views of another store)
+    def __init__(self, timings, bigrams, users, user_names, grouped=False):
+        timings = np.asarray(timings, dtype=np.int32)
+        bigrams = np.asarray(bigrams, dtype=np.int8)
+        users = np.asarray(users, dtype=np.int32)
+
+        group_keys = BIGRAM_CLASSES[bigrams] * NUM_BIGRAMS + bigrams
+        if not grouped:
+            order = np.argsort(group_keys, kind='mergesort')
+            timings, bigrams, users, group_keys = timings[order], bigrams[order], users[order], group_keys[order]
+
+        self.timings = timings
+        self.bigrams = bigrams
+        self.users = users
+        self.user_names = list(user_names)
+
+        # where every bigram and every distance class starts and ends
+        bigram_keys = BIGRAM_CLASSES * NUM_BIGRAMS + np.arange(NUM_BIGRAMS)
+        self.__bigram_starts = np.searchsorted(group_keys, bigram_keys, side='left')
+        self.__bigram_ends = np.searchsorted(group_keys, bigram_keys, side='right')
+        class_keys = np.arange(len(distance_classes) + 1) * NUM_BIGRAMS
+        self.__class_bounds = np.searchsorted(group_keys, class_keys, side='left')
+
+        self.__user_stores = None
+
+    ##
+    # This function builds a store from cleaned attempts, taking the differences
+    # between consecutive keystrokes of every attempt all at once
+    #
+    # @input attempts - a CleanedAttempts
+    # @returns a TimingStore of every bigram of every attempt
+    @staticmethod
+    def from_attempts(attempts):
+        keys = np.asarray(attempts.keys, dtype=np.int64)
+        times = np.asarray(attempts.times, dtype=np.int64)
+        offsets = np.asarray(attempts.attempt_offsets, dtype=np.int64)
+
+        # a keystroke pairs with the next one unless it ends its attempt
+        pairs = np.ones(max(keys.shape[0] - 1, 0), dtype=bool)
+        pairs[offsets[1:-1] - 1] = False
+
+        timings = ((times[1:] - times[:-1]) // (10**3))[pairs]
+        bigrams = (keys[:-1] * NUM_KEYS + keys[1:])[pairs]
+        users = np.repeat(np.asarray(attempts.attempt_users), np.diff(offsets))[:-1][pairs]
+        profiling.count("timing_store.bigrams_produced", timings.shape[0])
+
+        return TimingStore(timings, bigrams, users, [str(user) for user in attempts.user_names])
+
+    ##
+    # @input keypair - a keypair (e.g. "12")
+    # @returns an array of every timing of the keypair (a view, not a copy)
+    def bigram(self, keypair):
+        code = bigram_code(keypair)
+        if code < 0:
+            return self.timings[:0]
+        return self.timings[self.__bigram_starts[code]:self.__bigram_ends[code]]
+
+    ##
+    # @input set_name - the name of a distance class (e.g. "dist_one")
+    # @returns an array of every timing of the class (a view, not a copy)
+    def distance_class(self, set_name):
+        class_id = distance_class_ids[set_name]
+        return self.timings[self.__class_bounds[class_id]:self.__class_bounds[class_id + 1]]
+
+    ##
+    # This function collects the timings of any set of keypairs in common.all_sets; distance
+    # classes are views, while sets that cut across them (e.g. "dist_one_left") are copied
+    #
+    # @input set_name - the name of a set (e.g. "dist_one_left")
+    # @returns an array of every timing of the set
+    def set_timings(self, set_name):
+        if set_name in distance_class_ids:
+            return self.distance_class(set_name)
+        return np.concatenate([self.timings[:0]] + [self.bigram(keypair) for keypair in all_sets[set_name]])
+
+    ##
+    # This function splits the store by user. The first call groups every timing
+    # by user in one pass; every call after that is a lookup
+    #
+    # @input user - the name of a user
+    # @returns a TimingStore of the timings of that user alone
+    def user(self, user):
+        if self.__user_stores is None:
+            # a stable sort keeps every user's timings grouped by class and bigram
+            order = np.argsort(self.users, kind='mergesort')
+            timings, bigrams, users = self.timings[order], self.bigrams[order], self.users[order]
+            bounds = np.searchsorted(users, np.arange(len(self.user_names) + 1))
+
+            self.__user_stores = {}
+            for user_id, name in enumerate(self.user_names):
+                start, end = bounds[user_id], bounds[user_id + 1]
+                self.__user_stores[name] = TimingStore(timings[start:end], bigrams[start:end], users[start:end],
+                                                       self.user_names, grouped=True)
+
+        return self.__user_stores[user]
+
+    ##
+    # This function marks which timings fall below a percentile cutoff, without copying any of them.
+    # With a "user" or "class" scope, the cutoffs of every group are found in one sort
+    #
+    # @input percentile - the threshold above which data counts as an outlier
+    #                       (defaults to 95th, as in top 5% are outliers)
+    # @input scope - "global" for one cutoff over every timing, "user" for a cutoff per user,
+    #                   or "class" for a cutoff per distance class
+    # @returns a boolean array, True for every timing to keep
+    def outlier_mask(self, percentile=95, scope="global"):
+        if scope == "global":
+            if self.timings.shape[0] == 0:
+                return np.zeros(0, dtype=bool)
+            return self.timings < np.percentile(self.timings, percentile)
+
+        if scope == "user":
+            groups = self.users
+            num_groups = len(self.user_names)
+        elif scope == "class":
+            groups = BIGRAM_CLASSES[self.bigrams]
+            num_groups = len(distance_classes) + 1
+        else:
+            raise ValueError("unknown scope for outliers: " + str(scope))
+
+        return self.timings < group_percentiles(self.timings, groups, num_groups, percentile)[groups]
+
+    ##
+    # @input mask - a boolean array, True for every timing to keep
+    # @returns a TimingStore of the timings that the mask keeps
+    def select(self, mask):
+        # masking keeps the grouping by class and bigram
+        return TimingStore(self.timings[mask], self.bigrams[mask], self.users[mask], self.user_names, grouped=True)
+
+    ##
+    # This function roots out the highest X% of data as outliers
+    #
+    # @input percentile - the threshold above which data gets thrown out
+    #                       (defaults to 95th, as in top 5% gets thrown out)
+    # @input scope - whether the cutoff is "global", per "user" or per distance "class" (see outlier_mask)
+    # @returns a TimingStore without the outliers
+    def filtered(self, percentile=95, scope="global"):
+        return self.select(self.outlier_mask(percentile, scope))
+
+    ##
+    # @returns a list of a TimingStore per user, in the order of user_names
+    def per_user(self):
+        return [self.user(name) for name in self.user_names]
+
+    ##
+    # The functions below let a store stand in for the dictionaries of lists of ints
+    # that parse_data returns, with arrays in place of lists
+
+    def keys(self):
+        present = np.flatnonzero(self.__bigram_ends > self.__bigram_starts)
+        return [BIGRAMS[code] for code in present]
+
+    def items(self):
+        return [(keypair, self.bigram(keypair)) for keypair in self.keys()]
+
+    def values(self):
+        return [self.bigram(keypair) for keypair in self.keys()]
+
+    def get(self, keypair, default=None):
+        if keypair not in self:
+            return default
+        return self.bigram(keypair)
+
+    def __getitem__(self, keypair):
+        return self.bigram(keypair)
+
+    def __contains__(self, keypair):
+        code = bigram_code(keypair)
+        return code >= 0 and self.__bigram_ends[code] > self.__bigram_starts[code]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+# End of file
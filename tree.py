@@ -2,14 +2,20 @@
 # Tree class for the PIN inference software
 ##
 from node import Node
+import profiling
+
+# the number of nodes in a tree of every 4 digit PIN, root included
+NODES_PER_TREE = sum(10 ** level for level in range(5))
 
 
 class Tree:
+    @profiling.timed("tree.Tree")
     def __init__(self, model, t1, t2, t3, t4):
         self.root = Node(None, "e", model, 0)
         self.model = model
         self.timings = [t1, t2, t3, t4]
         self.build(self.root, 0)
+        profiling.count("tree.nodes_allocated", NODES_PER_TREE)
 
     ##
     # @returns the root node of this tree
@@ -32,6 +38,7 @@ class Tree:
     # This function ranks all possible PINs in the order of highest
     # to lowest probability
     ##
+    @profiling.timed("tree.rank_by_probability")
     def rank_by_probability(self):
         pin_list = self.extract()
         pin_sorted = sorted(pin_list, key=lambda x: x[1], reverse=True)